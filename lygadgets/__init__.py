@@ -5,6 +5,6 @@ from lygadgets.environment import pya, isGUI, isGSI, patch_environment, klayout_
 from lygadgets.messaging import message, message_loud
 from lygadgets.markup import lyp_to_layerlist
 from lygadgets.system_linker import export_to_system
-from lygadgets.cell_translation import anyCell_to_anyCell, any_read, any_write
+from lygadgets.cell_translation import anyCell_to_anyCell, any_read, any_write, translate_many
 from lygadgets.autolibrary import WrappedPCell, WrappedLibrary
 from lygadgets.technology import Technology
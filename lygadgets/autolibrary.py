@@ -11,8 +11,69 @@
 
 from lygadgets import pya
 import os
+import io
+import sys
+import time
+import hashlib
+import inspect
+import itertools
 from inspect import signature
-from lygadgets import anyCell_to_anyCell
+from lygadgets import anyCell_to_anyCell, any_read, any_write, klayout_home
+from lygadgets.cell_translation import TranslationCache
+from lygadgets.caching import DiskCache
+from lygadgets import profiling
+
+# Geometry produced by WrappedPCells, keyed by generating function, display text, and dbu.
+# Check pcell_cache.info() for hits, misses, and size. Set maxsize=0 to turn it off
+pcell_cache = TranslationCache(maxsize=256)
+
+# Same, but on disk as OASIS, so it lasts between sessions. Off until use_persistent_cache is called
+persistent_cache = None
+
+
+def use_persistent_cache(directory=None, maxbytes=256 * 2 ** 20):
+    ''' Turns on the on-disk cache of WrappedPCell geometry. It goes in klayout_home()/lygadgets_cache/pcells by default.
+        Use directory=False to turn it off again.
+    '''
+    global persistent_cache
+    if directory is False:
+        persistent_cache = None
+        return None
+    if directory is None:
+        directory = os.path.join(klayout_home(), 'lygadgets_cache', 'pcells')
+    persistent_cache = DiskCache(directory, maxbytes=maxbytes, suffix='.oas')
+    return persistent_cache
+
+
+def function_fingerprint(function):
+    ''' SHA1 of the code of a generating function and the versions of the packages that affect its geometry.
+        When the function is edited, this changes, so old cached geometry is never used.
+        Edits to other functions that it calls are not seen. Bump the version of your package (or clear the cache) for those.
+    '''
+    hasher = hashlib.sha1()
+    hasher.update('{}.{}'.format(function.__module__, getattr(function, '__qualname__', function.__name__)).encode())
+    try:
+        hasher.update(inspect.getsource(function).encode())
+    except (OSError, TypeError):  # no source file. Use the bytecode
+        code = function.__code__
+        hasher.update(code.co_code)
+        hasher.update(repr(code.co_consts).encode())
+    package_name = (function.__module__ or '').split('.')[0]
+    for name in [package_name, 'lygadgets', 'phidl']:
+        module = sys.modules.get(name)
+        hasher.update('{}={}'.format(name, getattr(module, '__version__', None)).encode())
+    return hasher.hexdigest()
+
+
+def count_shapes(pya_cell):
+    ''' Shapes in the cell and its subcells, on all layers. Each subcell is counted once, not once per instance '''
+    layout = pya_cell.layout()
+    total = 0
+    for cell_index in [pya_cell.cell_index()] + list(pya_cell.called_cells()):
+        cell = layout.cell(cell_index)
+        for layer in layout.layer_indexes():
+            total += cell.shapes(layer).size()
+    return total
 
 def cellname_to_kwargs(cellname):
     ''' Converts the naming convention for parameter-based cell naming back into a dict of kwargs '''
@@ -67,6 +128,9 @@ if pya is None:
     class WrappedPCell(object):
         def __init__(self, *args, **kwargs):
             raise AttributeError('WrappedPCell requires a working installation of klayout python package')
+    class LazyWrappedPCell(object):
+        def __init__(self, *args, **kwargs):
+            raise AttributeError('LazyWrappedPCell requires a working installation of klayout python package')
     class WrappedLibrary(object):
         def __init__(self, *args, **kwargs):
             raise AttributeError('WrappedLibrary requires a working installation of klayout python package')
@@ -80,8 +144,16 @@ else:
 
             I think this is not specific to phidl implementation. It just needs some function.
             Oh wait, yes it is (barely) because of write_gds.
+
+            With out_of_process = True, the generating function runs in a warm worker process (see pcell_worker),
+            and klayout shows a progress bar, which can be cancelled, while it waits.
+            If it takes more than timeout seconds, or is cancelled, the cell gets a placeholder on placeholder_layer.
+            Placeholders are not cached. Change a parameter back and forth to try again.
         '''
         generating_function = None
+        out_of_process = False
+        timeout = 60.
+        placeholder_layer = (255, 0)
 
         def kwargs_to_params(self):
             ''' Extracts the arguments of the generating_function and registers them as params of this object
@@ -102,22 +174,38 @@ else:
             # todo: handle non-keyword args
             all_args = list()
             all_kwargs = dict()
-            for pdecl, pval in zip(self.get_parameters(), self.get_values()):
+            for pdecl, pval in zip(self.get_parameters(), self.current_values()):
                 all_kwargs[pdecl.name] = pval
             return all_args, all_kwargs
 
-        def __init__(self, generating_function):
+        def current_values(self):
+            ''' The parameter values that klayout is currently asking about '''
+            try:
+                return self.get_values()
+            except AttributeError:  # the standalone PCellDeclarationHelper keeps them privately
+                return self._param_values
+
+        def __init__(self, generating_function, out_of_process=None, timeout=None):
             self.generating_function = generating_function
+            if out_of_process is not None:
+                self.out_of_process = out_of_process
+            if timeout is not None:
+                self.timeout = timeout
             super().__init__()
             self.kwargs_to_params()
+            self._function_fingerprint = None
 
         def display_text_impl(self):
             ''' Produces a string that includes all of the parameters. This means it is unique for identical cells.
                 We assume that the pcells are functional in the sense that identical parameters yield identical geometry.
                 In this way, different pcell instances with the same arguments are correctly identified as the same cell.
             '''
+            return self.display_text_for(self.current_values())
+
+        def display_text_for(self, values):
+            ''' display_text_impl for these parameter values, in the order of get_parameters '''
             text = self.generating_function.__name__ + '_'
-            for pdecl, pval in zip(self.get_parameters(), self.get_values()):
+            for pdecl, pval in zip(self.get_parameters(), values):
                 # sanitize _'s and ='s
                 if isinstance(pval, str):
                     pval.replace('_', '[_]')
@@ -125,16 +213,172 @@ else:
                 text += '_{}={}'.format(pdecl.name, pval)
             return text
 
+        def values_for(self, kwargs):
+            ''' Parameter values in the order of get_parameters, like klayout would give them to produce_impl:
+                the defaults, updated by kwargs
+            '''
+            unknown = set(kwargs.keys()) - set(pdecl.name for pdecl in self.get_parameters())
+            if unknown:
+                raise ValueError('{} has no parameters {}'.format(self.generating_function.__name__, sorted(unknown)))
+            coercions = {pya.PCellDeclarationHelper.TypeInt: int,
+                         pya.PCellDeclarationHelper.TypeDouble: float,
+                         pya.PCellDeclarationHelper.TypeString: str,
+                         pya.PCellDeclarationHelper.TypeBoolean: bool}
+            values = []
+            for pdecl in self.get_parameters():
+                value = kwargs.get(pdecl.name, pdecl.default)
+                if pdecl.type in coercions and value is not None:
+                    value = coercions[pdecl.type](value)
+                values.append(value)
+            return values
+
+        def cache_key(self, values=None, dbu=None):
+            ''' Identifies the geometry. Same as display_text_impl, except the generating function is there itself,
+                not just its name, and the database unit matters.
+                Default is the current values and the layout being produced into.
+            '''
+            if values is None:
+                values = self.current_values()
+            if dbu is None:
+                dbu = self.layout.dbu
+            return (self.generating_function, self.display_text_for(values), round(dbu, 12))
+
+        def persistent_key(self, values=None, dbu=None):
+            ''' Like cache_key, but as a hex digest that is stable between sessions.
+                The generating function is identified by function_fingerprint
+            '''
+            if self._function_fingerprint is None:
+                self._function_fingerprint = function_fingerprint(self.generating_function)
+            _, text, dbu = self.cache_key(values, dbu)
+            return hashlib.sha1('{}|{}|{}'.format(self._function_fingerprint, text, dbu).encode()).hexdigest()
+
         def produce_impl(self):
-            ''' Creates a fixed cell instance based on the previously specified parameters
+            ''' Creates a fixed cell instance based on the previously specified parameters.
+                If these parameters have been produced before in this session, the geometry is copied from pcell_cache.
+                If persistent_cache is on, and they were produced in an earlier session, it is read from there.
+            '''
+            with profiling.record(self.generating_function.__name__):
+                use_cache = pcell_cache.maxsize != 0
+                if use_cache:
+                    key = self.cache_key()
+                    with profiling.phase('cache'):
+                        hit = pcell_cache.lookup(key, self.cell)
+                    if hit is not None:
+                        profiling.count_polygons(count_shapes(self.cell))
+                        return
+                disk_cache = persistent_cache
+                if disk_cache is not None:
+                    disk_key = self.persistent_key()
+                    filename = disk_cache.lookup(disk_key)
+                    if filename is not None:
+                        try:
+                            with profiling.phase('disk_cache'):
+                                any_read(self.cell, filename)
+                        except Exception:  # maybe deleted or evicted by another session. Produce it again
+                            self.cell.clear()
+                        else:
+                            if use_cache:
+                                pcell_cache.insert(key, self.cell)
+                            profiling.count_polygons(count_shapes(self.cell))
+                            return
+                # Produce the geometry
+                args, kwargs = self.params_to_kwargs()
+                if self.out_of_process:
+                    with profiling.phase('generate'):
+                        try:
+                            data = self.generate_out_of_process(kwargs)
+                        except TimeoutError as err:
+                            self.produce_placeholder(str(err))
+                            return
+                    with profiling.phase('translate'):
+                        any_read(self.cell, io.BytesIO(data))
+                else:
+                    with profiling.phase('generate'):
+                        phidl_Device = self.generating_function(*args, **kwargs)
+                    # Convert phidl.Device to pya.Cell - just geometry
+                    with profiling.phase('translate'):
+                        anyCell_to_anyCell(phidl_Device, self.cell)
+                with profiling.phase('cache_insert'):
+                    if use_cache:
+                        pcell_cache.insert(key, self.cell)
+                    if disk_cache is not None:
+                        disk_cache.insert(disk_key, lambda filename: any_write(self.cell, filename, format='OASIS'))
+                profiling.count_polygons(count_shapes(self.cell))
+                # Transfer other data (ports, metadata, CML files, etc.)
+                pass  # TODO
+
+        def generate_out_of_process(self, kwargs):
+            ''' GDS bytes from the worker process, with a progress bar while waiting.
+                Raises TimeoutError after self.timeout seconds, or when the progress bar is cancelled
             '''
-            # Produce the geometry
-            args, kwargs = self.params_to_kwargs()
-            phidl_Device = self.generating_function(*args, **kwargs)
-            # Convert phidl.Device to pya.Cell - just geometry
-            anyCell_to_anyCell(phidl_Device, self.cell)
-            # Transfer other data (ports, metadata, CML files, etc.)
-            pass  # TODO
+            from lygadgets.pcell_worker import get_worker
+            progress = pya.AbsoluteProgress('Generating {}'.format(self.generating_function.__name__))
+            progress.format = '%.1f s'
+            progress.unit = 1
+            tstart = time.monotonic()
+
+            def poll():
+                try:
+                    progress.set(time.monotonic() - tstart, True)  # also lets klayout handle events
+                except RuntimeError as err:  # cancelled in the GUI
+                    raise TimeoutError('cancelled') from err
+            try:
+                return get_worker().generate(self.generating_function, kwargs, timeout=self.timeout, poll=poll)
+            finally:
+                progress._destroy()
+
+        def produce_placeholder(self, reason):
+            ''' A box with the function name and reason, instead of the geometry '''
+            layer = self.layout.layer(*self.placeholder_layer)
+            size = int(round(10 / self.layout.dbu))
+            self.cell.shapes(layer).insert(pya.Box(0, 0, size, size))
+            text = '{}: {}'.format(self.generating_function.__name__, reason)
+            self.cell.shapes(layer).insert(pya.Text(text, pya.Trans(size // 10, size // 2)))
+
+
+    class LazyWrappedPCell(pya.PCellDeclaration):
+        ''' Stands in for a WrappedPCell until klayout first needs it.
+            Registering one does nothing but remember the generating function.
+            The WrappedPCell, with its signature inspection and parameter declarations,
+            is only built when klayout first asks for parameters or geometry. Everything is then forwarded to it.
+        '''
+        def __init__(self, generating_function, **options):
+            super().__init__()
+            self.generating_function = generating_function
+            self.options = options
+            self._wrapped = None
+
+        def wrapped(self):
+            if self._wrapped is None:
+                self._wrapped = WrappedPCell(self.generating_function, **self.options)
+            return self._wrapped
+
+        def get_parameters(self):
+            return self.wrapped().get_parameters()
+
+        def get_layers(self, parameters):
+            return self.wrapped().get_layers(parameters)
+
+        def display_text(self, parameters):
+            return self.wrapped().display_text(parameters)
+
+        def coerce_parameters(self, layout, parameters):
+            return self.wrapped().coerce_parameters(layout, parameters)
+
+        def produce(self, layout, layers, parameters, cell):
+            return self.wrapped().produce(layout, layers, parameters, cell)
+
+        def callback(self, layout, name, states):
+            return self.wrapped().callback(layout, name, states)
+
+        def can_create_from_shape(self, layout, shape, layer):
+            return self.wrapped().can_create_from_shape(layout, shape, layer)
+
+        def parameters_from_shape(self, layout, shape, layer):
+            return self.wrapped().parameters_from_shape(layout, shape, layer)
+
+        def transformation_from_shape(self, layout, shape, layer):
+            return self.wrapped().transformation_from_shape(layout, shape, layer)
 
 
     class WrappedLibrary(pya.Library):
@@ -146,10 +390,18 @@ else:
 
             To subclass this class, no extra methods are needed.
             Just override the class attributes.
+            Set cache_on_disk = True to keep produced geometry between sessions (see use_persistent_cache).
+            If you know which variants will be used, produce them all at once, in parallel, with pregenerate.
+            Set lazy = True to speed up startup for big libraries: each PCell is only set up when it is first used.
+            Set out_of_process = True to keep the GUI responsive while slow PCells are produced (see WrappedPCell).
+            To see which PCells are slow to produce, and where the time goes, print(MyLibrary().stats_report()).
         '''
         tech_name = None
         all_funcs_to_wrap = None
         description = None
+        cache_on_disk = False
+        lazy = False
+        out_of_process = False
 
         def __init__(self):
             if self.tech_name is None or self.all_funcs_to_wrap is None:
@@ -157,11 +409,17 @@ else:
 
             print("Initializing '%s' Library." % self.tech_name)
 
+            if self.cache_on_disk and persistent_cache is None:
+                use_persistent_cache()
+
             # Not doing fixed GDS in this Library
 
             # Create all the new klayout-format PCells
+            declaration_class = LazyWrappedPCell if self.lazy else WrappedPCell
+            self.wrapped_pcells = dict()
             for func in self.all_funcs_to_wrap:
-                self.layout().register_pcell(func.__name__, WrappedPCell(func))  # generic version
+                self.wrapped_pcells[func.__name__] = declaration_class(func, out_of_process=self.out_of_process)
+                self.layout().register_pcell(func.__name__, self.wrapped_pcells[func.__name__])  # generic version
 
             self.register(self.tech_name)
 
@@ -169,6 +427,111 @@ else:
                 # KLayout v0.25 introduced technology variable:
                 self.technology = self.tech_name
 
+        def pregenerate(self, variants, processes=None):
+            ''' Produces PCell variants ahead of time, in parallel. See pregenerate_pcells.
+
+                    MyLibrary().pregenerate({'ring': {'radius': [5, 10, 20], 'gap': [0.1, 0.2]}})
+            '''
+            pcells = dict()
+            for name, pcell in self.wrapped_pcells.items():
+                pcells[name] = pcell.wrapped() if isinstance(pcell, LazyWrappedPCell) else pcell
+            return pregenerate_pcells(pcells, variants, dbu=self.layout().dbu, processes=processes)
+
+        def stats(self):
+            ''' Production statistics of this library's PCells, by function name:
+                calls, seconds, polygons, and phases (cache, generate, translate, ...: seconds).
+                See lygadgets.profiling
+            '''
+            return profiling.stats(names=self.wrapped_pcells.keys())
+
+        def stats_report(self):
+            ''' stats as a table, slowest first '''
+            return profiling.report(names=self.wrapped_pcells.keys())
+
+
+def _expand_variants(variants):
+    ''' Gives (function name, kwargs) pairs from a list of them, or from {function name: {parameter: [values]}} '''
+    if isinstance(variants, dict):
+        for name, grid in variants.items():
+            parameters = list(grid.keys())
+            for combination in itertools.product(*(grid[p] for p in parameters)):
+                yield name, dict(zip(parameters, combination))
+    else:
+        for name, kwargs in variants:
+            yield name, kwargs
+
+
+def _produce_oasis(generating_function, kwargs, dbu):
+    ''' Runs in worker processes of pregenerate_pcells. Same as produce_impl, but returns OASIS bytes '''
+    layout = pya.Layout()
+    layout.dbu = dbu
+    cell = layout.create_cell(generating_function.__name__)
+    anyCell_to_anyCell(generating_function(**kwargs), cell)
+    buffer = io.BytesIO()
+    any_write(cell, buffer, format='OASIS')
+    return buffer.getvalue()
+
+
+def pregenerate_pcells(wrapped_pcells, variants, dbu=0.001, processes=None):
+    ''' Produces PCell variants ahead of time into pcell_cache, and into persistent_cache if that is on.
+        When klayout later asks for them, produce_impl just copies the geometry.
+
+        wrapped_pcells is a dict of name -> WrappedPCell.
+        variants is a list of (name, kwargs), or a parameter grid: {name: {parameter name: [values]}}, for all combinations.
+        The generating functions run in a pool of processes (default: one per CPU). processes=1 runs them here, one by one.
+        The generating functions must be importable by name in the worker processes, which they are if they come from a module.
+        Inside KLayout, the workers run system python (see pcell_worker.process_pool).
+
+        Variants that are already cached are skipped. Returns how many were generated.
+        Without persistent_cache, raises ValueError if the new variants do not fit in pcell_cache along with what is there.
+    '''
+    if pcell_cache.maxsize == 0 and persistent_cache is None:
+        raise ValueError('There is no cache to pregenerate into. Turn on pcell_cache or persistent_cache')
+    jobs = []
+    for name, kwargs in _expand_variants(variants):
+        pcell = wrapped_pcells[name]
+        values = pcell.values_for(kwargs)
+        if pcell.cache_key(values, dbu) in pcell_cache:
+            continue
+        if persistent_cache is not None and pcell.persistent_key(values, dbu) in persistent_cache:
+            continue
+        full_kwargs = dict(zip([pdecl.name for pdecl in pcell.get_parameters()], values))
+        jobs.append((pcell, values, full_kwargs))
+    if not jobs:
+        return 0
+
+    if persistent_cache is None and pcell_cache.maxsize is not None and len(pcell_cache) + len(jobs) > pcell_cache.maxsize:
+        # The first variants would be evicted by the last ones
+        raise ValueError('{} variants do not fit in pcell_cache (maxsize={}, {} there already). '
+                         'Raise pcell_cache.maxsize or turn on persistent_cache'.format(len(jobs), pcell_cache.maxsize, len(pcell_cache)))
+
+    functions = [pcell.generating_function for pcell, _, _ in jobs]
+    all_kwargs = [full_kwargs for _, _, full_kwargs in jobs]
+    scratch = pya.Layout()
+    scratch.dbu = dbu
+    pool = None
+    try:
+        if processes == 1:
+            streams = map(_produce_oasis, functions, all_kwargs, [dbu] * len(jobs))
+        else:
+            from lygadgets.pcell_worker import process_pool
+            pool = process_pool(processes)
+            chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1)))
+            streams = pool.map(_produce_oasis, functions, all_kwargs, [dbu] * len(jobs), chunksize=chunksize)
+        for (pcell, values, _), data in zip(jobs, streams):
+            if pcell_cache.maxsize != 0:
+                cell = any_read(scratch.create_cell('pregenerated'), io.BytesIO(data))
+                pcell_cache.insert(pcell.cache_key(values, dbu), cell)
+            if persistent_cache is not None:
+                def write_data(filename, data=data):
+                    with open(filename, 'wb') as fx:
+                        fx.write(data)
+                persistent_cache.insert(pcell.persistent_key(values, dbu), write_data)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return len(jobs)
+
 
 # class WrappedKLayoutPCell(siepic.KLayoutPCell):
 #     pass
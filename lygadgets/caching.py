@@ -0,0 +1,165 @@
+''' Small caches used by cell translation and PCells.
+
+    LRUCache is in-process. It is like functools.lru_cache, except the values are layout objects
+    that need special handling when they are stored, handed out, or thrown away.
+    Subclasses override _store, _retrieve, and _discard to do that.
+
+    DiskCache is a directory of files that survives between sessions.
+'''
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    ''' Bounded mapping with least-recently-used eviction and hit/miss counters.
+        Safe to use from multiple threads.
+    '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _store(self, value):
+        ''' Converts a value into what is kept in the cache. Default: keep as is '''
+        return value
+
+    def _retrieve(self, entry, *args):
+        ''' Converts what is kept in the cache into what is handed out. Default: hand out as is '''
+        return entry
+
+    def _discard(self, entry):
+        ''' Called when an entry is evicted or cleared '''
+        pass
+
+    def lookup(self, key, *args):
+        ''' Returns the cached value (via _retrieve) or None. Counts a hit or a miss. '''
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._retrieve(entry, *args)
+
+    def insert(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._discard(self._entries.pop(key))
+            self._entries[key] = self._store(value)
+            while self.maxsize is not None and len(self._entries) > self.maxsize:
+                _, oldest = self._entries.popitem(last=False)
+                self._discard(oldest)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                self._discard(entry)
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+class DiskCache(object):
+    ''' Directory of files, one per key, bounded by total size. Keys are hex digests.
+
+        Files are written to a temporary name and then renamed, so a reader (maybe another KLayout session)
+        never sees half of a file. Hits touch the file, and when the directory is over maxbytes,
+        the files that were least recently touched are deleted.
+    '''
+    def __init__(self, directory, maxbytes=256 * 2 ** 20, suffix=''):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def lookup(self, key):
+        ''' Returns the filename of the entry, or None. Counts a hit or a miss '''
+        filename = self.path(key)
+        try:
+            os.utime(filename)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return filename
+
+    def insert(self, key, write_function):
+        ''' Calls write_function(filename) to write the entry, then puts it in place '''
+        fd, temporary = tempfile.mkstemp(prefix='.' + key, suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        try:
+            write_function(temporary)
+            os.replace(temporary, self.path(key))
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix) and not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:  # deleted by somebody else
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def __len__(self):
+        return len(self._entries())
+
+    def clear(self):
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        ''' maxsize and currsize are in bytes '''
+        return CacheInfo(self.hits, self.misses, self.maxbytes, self.size())
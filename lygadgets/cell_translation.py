@@ -1,182 +1,426 @@
 ''' Translation functions that take Cells/Devices in different types of languages
     and convert them to Cells/Devices in other languages
 
-    Supported: phidl, pya (GSI version), klayout.db (standalone version)
+    Supported: phidl, pya (GSI version), klayout.db (standalone version), gdstk
     Not yet supported: nazca, IPKISS, gdspy, other suggestions?
+    Each language is a Backend. More can be added with register_backend.
 
     Todo:
     - zeropdk read/write geometric ports
-    - rudimentary pya2phidl_flat
-    - use tempfile.TemporaryFile within anyCell_to_anyCell
     - better document and debug anyCell_to_anyCell
+
+    Writers and readers accept either a filename or a binary stream (like io.BytesIO).
+    When both sides support streams, anyCell_to_anyCell never touches the disk.
+    The intermediate format is negotiated per pair: OASIS if both sides can do it, otherwise GDS2 (see intermediate_format).
+    Some pairs of languages skip GDS entirely and convert object-to-object (see celltypes_to_direct_function).
+
+    Concurrency: translations can run at the same time in threads or processes (ThreadPoolExecutor, ProcessPoolExecutor, pytest-xdist).
+    Every option is per call, and the temporary file, when there is one, lives in its own temporary directory.
+    Only share a pya.Layout between threads if you are not writing to it at the same time.
 '''
 import os
+import sys
+import io
+import copy
+import tempfile
+import hashlib
+import weakref
+from lygadgets import gdsii, profiling
+from lygadgets.caching import LRUCache
 
 default_phidl_portlayer = 41
-do_write_ports = True
+do_write_ports = True  # default for any_write of phidl Devices. Override per call with write_ports=
 
-def celltype_to_write_function(celltype):
-    ''' Takes a class that represents a layout Cell and gives a function that writes its geometry to disc
-        This is typically an unbound method of the class.
-        (there is always some version of this, although some languages don't explicitly call it Cell)
+class Backend(object):
+    ''' A layout language that cells can be written from and read into.
 
-        This uses try-excepted on-the-fly importing because not everybody is going to have every language installed.
-        But if they don't, then their celltype is not going to be from that language.
+        Backends are looked at in the order they were registered (see register_backend),
+        but only once their module has been imported by somebody: a cell cannot belong to a language that nobody imported.
+        The first time a backend is looked at, it says which classes are its cells (celltypes).
+        After that, the class -> backend and class -> reader/writer lookups are cached.
     '''
-    def not_supported_error(language_name):
-        raise NotImplementedError(('The translator does not yet support {}.\n'.format(language_name)
-                                    + 'Supported languages are: pya, phidl\n'
-                                    + 'Future support will include: gdspy, nazca, ipkiss'))
-
-    if type(celltype) is not type:
-        celltype = type(celltype)
+    name = None
+    module = None  # Name of the module that the cells come from. The backend is ignored until it is in sys.modules
 
-    try: import pya  # ok I know we already imported this, but in the future it can also be on-the-fly (i.e. converting phidl to nazca)
-    except ImportError: pass
-    else:
-        if issubclass(celltype, pya.Cell):
-            return pya.Cell.write
-        elif issubclass(celltype, pya.Layout):
-            return pya.Layout.write
-
-    try: import phidl
-    except ImportError: pass
-    else:
-        if issubclass(celltype, (phidl.Device, phidl.device_layout.DeviceReference)):
-            if do_write_ports:
-                def write_with_ports(device, filename, *args, port_layer=None, **kwargs):
-                    if port_layer is None:
-                        port_layer = default_phidl_portlayer
-                    # If its a reference, use its parent
-                    if issubclass(celltype, phidl.device_layout.DeviceReference):
-                        device = device.parent
-                    # Try to convert to geometric ports
-                    try:
-                        port2geom = phidl.geometry.ports_to_geometry
-                    except AttributeError:  # it is an older version of phidl
-                        pass
-                    else:
-                        device = port2geom(device, layer=port_layer)
-                    # The actual write
-                    device.write_gds(filename, *args, **kwargs)
-                return write_with_ports
-            else:
-                def write_parent(device, filename, *args, **kwargs):
-                    # If its a reference, use its parent
-                    if issubclass(celltype, phidl.device_layout.DeviceReference):
-                        device = device.parent
-                    device.write_gds(filename, *args, **kwargs)
-                return write_parent
+    def celltypes(self):
+        ''' Tuple of the cell classes handled by this backend. Only called when module has been imported '''
+        raise NotImplementedError
 
-    # try: import gdspy
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('gdspy')
+    def write_function(self, celltype):
+        ''' Gives function(cell, filename, *args, format=None, write_ports=None, **kwargs), or None if celltype cannot be written.
+            filename can also be a binary stream if supports_streams.
+        '''
+        return None
 
-    # try: import nazca
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('nazca')
+    def read_function(self, celltype):
+        ''' Gives function(cell, filename, *args, **kwargs) that puts the geometry in cell and returns it,
+            or None if celltype cannot be read into.
+        '''
+        return None
 
-    # try: import ipkiss
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('ipkiss')
+    def supports_streams(self, celltype):
+        ''' Whether the read and write functions can work with binary streams instead of filenames '''
+        return False
 
-    raise TypeError('celltype: {} is not recognized as a layout cell object'.format(celltype.__name__))
+    def formats(self, celltype):
+        ''' The intermediate file formats that this celltype can both write and read, in order of preference.
+            Format names are the ones used by klayout's SaveLayoutOptions.format
+        '''
+        return ('GDS2',)
 
 
-def any_write(cell, *args, **kwargs):
-    write = celltype_to_write_function(cell)
-    return write(cell, *args, **kwargs)
+class PyaBackend(Backend):
+    name = 'pya'
+    # GSI and the klayout package (0.27 and later) both provide a top level pya.
+    # Older standalones only have klayout.db, which lygadgets.environment does not alias to pya: they are not dispatched
+    module = 'pya'
 
+    def celltypes(self):
+        import pya
+        return (pya.Cell, pya.Layout)
 
-def celltype_to_read_function(celltype):
-    ''' Takes a class that represents a layout Cell and gives its class' read method.
-    '''
-    def not_supported_error(language_name):
-        raise NotImplementedError(('The translator does not yet support {}.\n'.format(language_name)
-                                    + 'Supported languages are: pya, phidl\n'
-                                    + 'Future support will include: gdspy, nazca, ipkiss'))
-
-    if type(celltype) is not type:
-        celltype = type(celltype)
+    def write_function(self, celltype):
+        import pya
+        if issubclass(celltype, pya.Cell):
+            def pyaCell_writer(pya_cell, filename, *args, format=None, write_ports=None, **kwargs):
+                # write_ports is ignored: klayout cells have no ports
+                if isinstance(filename, str) and format is None:
+                    return pya_cell.write(filename, *args, **kwargs)  # format from the file suffix
+                options = pya.SaveLayoutOptions()
+                options.format = format or 'GDS2'
+                options.select_cell(pya_cell.cell_index())
+                if isinstance(filename, str):
+                    pya_cell.layout().write(filename, options)
+                else:
+                    filename.write(pya_cell.layout().write_bytes(options))
+            return pyaCell_writer
+        else:
+            def pyaLayout_writer(pya_layout, filename, *args, format=None, write_ports=None, **kwargs):
+                if isinstance(filename, str) and format is None:
+                    return pya_layout.write(filename, *args, **kwargs)  # format from the file suffix
+                options = pya.SaveLayoutOptions()
+                options.format = format or 'GDS2'
+                if isinstance(filename, str):
+                    pya_layout.write(filename, options)
+                else:
+                    filename.write(pya_layout.write_bytes(options))
+            return pyaLayout_writer
 
-    try: import pya  # ok I know we already imported this, but in the future it can also be on-the-fly (i.e. converting phidl to nazca)
-    except ImportError: pass
-    else:
+    def read_function(self, celltype):
+        import pya
         if issubclass(celltype, pya.Cell):
-            def pyaCell_reader(pya_cell, filename, *args, **kwargs):
+            def pyaCell_reader(pya_cell, filename, *args, cellname=None, **kwargs):
+                if cellname is not None:
+                    return _read_pya_subtree(pya_cell, filename, cellname)
                 templayout = pya.Layout()
-                templayout.read(filename)
+                if isinstance(filename, str):
+                    templayout.read(filename)
+                else:
+                    templayout.read_bytes(filename.read())
                 tempcell = templayout.top_cell()
                 # Transfer the geometry of the imported cell to the one specified
                 pya_cell.name = tempcell.name
-                pya_cell.copy_tree(tempcell)
+                with profiling.phase('copy_tree'):
+                    pya_cell.copy_tree(tempcell)
                 return pya_cell
             return pyaCell_reader
+        return None
 
-    try: import phidl
-    except ImportError: pass
-    else:
-        if issubclass(celltype, phidl.Device):
-            def phidlDevice_reader(phidl_device, filename, *args, port_layer=None, **kwargs):
-                # phidl_device is not really used. It is just there to determine type.
-                if 'cellname' in kwargs:
-                    cellname = kwargs.pop('cellname')
-                else:
-                    #### hacks, because sometimes pya saves an extra topcell called $$$CONTEXT_INFO$$$
-                    from gdspy import GdsLibrary
-                    gdsii_lib = GdsLibrary()
-                    gdsii_lib.read_gds(filename)
-                    top_level_cells = gdsii_lib.top_level()
-                    if len(top_level_cells) == 1:
-                        cellname = top_level_cells[0].name
-                    elif len(top_level_cells) == 2:
-                        for tc in top_level_cells:
-                            if tc.name != '$$$CONTEXT_INFO$$$':
-                                cellname = tc.name
-                    else:
-                        raise ValueError('There are multiple top level cells: {}.\n Please specify with the cellname argument.'.format(top_level_cells))
-                    #### end hacks
-
-                # main read function
-                tempdevice = phidl.geometry.import_gds(filename, *args, cellname=cellname, **kwargs)
-
-                # check for port geometry
+    def supports_streams(self, celltype):
+        # Older klayout versions (< 0.29.9) do not have Layout.read_bytes, so they have to go through the disk.
+        import pya
+        return hasattr(pya.Layout, 'read_bytes') and hasattr(pya.Layout, 'write_bytes')
+
+    def formats(self, celltype):
+        return ('OASIS', 'GDS2')
+
+
+class PhidlBackend(Backend):
+    name = 'phidl'
+    module = 'phidl'
+
+    def celltypes(self):
+        import phidl
+        return (phidl.Device, phidl.device_layout.DeviceReference)
+
+    def write_function(self, celltype):
+        import phidl
+        def write_phidl(device, filename, *args, port_layer=None, format=None, write_ports=None,
+                        streaming=False, progress=None, **kwargs):
+            _check_gds_only(format, 'phidl')
+            if write_ports is None:
+                write_ports = do_write_ports
+            # If its a reference, use its parent
+            if issubclass(celltype, phidl.device_layout.DeviceReference):
+                device = device.parent
+            if streaming:
+                return write_phidl_streaming(device, filename, *args, port_layer=port_layer, write_ports=write_ports,
+                                             progress=progress, **kwargs)
+            if write_ports:
+                if port_layer is None:
+                    port_layer = default_phidl_portlayer
+                # Try to convert to geometric ports
                 try:
-                    wop = phidl.geometry.geometry_to_ports
-                except AttributeError:
+                    port2geom = phidl.geometry.ports_to_geometry
+                except AttributeError:  # it is an older version of phidl
                     pass
                 else:
-                    if port_layer is None:
-                        port_layer = default_phidl_portlayer
-                    tempdevice = wop(tempdevice, layer=port_layer)
-                # copy over from temporary device
-                phidl_device.polygons = tempdevice.polygons
-                phidl_device.references = tempdevice.references
-                phidl_device.ports = tempdevice.ports
-                phidl_device.labels = tempdevice.labels
-                phidl_device.name = tempdevice.name
-                return phidl_device
-            return phidlDevice_reader
-
-    # try: import gdspy
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('gdspy')
-
-    # try: import nazca
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('nazca')
-
-    # try: import ipkiss
-    # except ImportError: pass
-    # else:
-    #     not_supported_error('ipkiss')
-
-    raise TypeError('celltype: {} is not recognized as a layout cell object'.format(celltype.__name__))
+                    device = port2geom(device, layer=port_layer)
+            # The actual write
+            device.write_gds(filename, *args, **kwargs)
+        return write_phidl
+
+    def read_function(self, celltype):
+        import phidl
+        if not issubclass(celltype, phidl.Device):
+            return None
+        def phidlDevice_reader(phidl_device, filename, *args, port_layer=None, **kwargs):
+            # phidl_device is not really used. It is just there to determine type.
+            if 'cellname' in kwargs:
+                cellname = kwargs.pop('cellname')
+            else:
+                # This only scans the cell names. No geometry is loaded until import_gds
+                top_level_names = gdsii.top_cells(filename)
+                top_level_names = [name for name in top_level_names if name != gdsii.context_info_cellname]
+                if len(top_level_names) == 1:
+                    cellname = top_level_names[0]
+                else:
+                    raise ValueError('There are multiple top level cells: {}.\n Please specify with the cellname argument.'.format(top_level_names))
+
+            # main read function
+            tempdevice = phidl.geometry.import_gds(filename, *args, cellname=cellname, **kwargs)
+
+            # check for port geometry
+            try:
+                wop = phidl.geometry.geometry_to_ports
+            except AttributeError:
+                pass
+            else:
+                if port_layer is None:
+                    port_layer = default_phidl_portlayer
+                tempdevice = wop(tempdevice, layer=port_layer)
+            # copy over from temporary device
+            phidl_device.polygons = tempdevice.polygons
+            phidl_device.references = tempdevice.references
+            phidl_device.ports = tempdevice.ports
+            phidl_device.labels = tempdevice.labels
+            phidl_device.name = tempdevice.name
+            return phidl_device
+        return phidlDevice_reader
+
+    def supports_streams(self, celltype):
+        return True  # gdspy handles file objects
+
+    def formats(self, celltype):
+        return ('GDS2',)  # gdspy does not do OASIS
+
+
+class GdstkBackend(Backend):
+    ''' gdstk is much faster than gdspy at reading and writing GDS and OASIS.
+        It only works with filenames, so translations to and from gdstk go through the temporary file.
+    '''
+    name = 'gdstk'
+    module = 'gdstk'
+
+    def celltypes(self):
+        import gdstk
+        return (gdstk.Cell, gdstk.Library)
+
+    def write_function(self, celltype):
+        import gdstk
+        def gdstk_writer(cell, filename, *args, format=None, write_ports=None, **kwargs):
+            # write_ports is ignored: gdstk cells have no ports
+            # args and kwargs are for the Library (unit, precision) if cell is a Cell
+            if isinstance(cell, gdstk.Cell):
+                library = gdstk.Library(*args, **kwargs)
+                library.add(cell, *cell.dependencies(True))
+            else:
+                library = cell
+            if format is None:
+                format = 'OASIS' if _is_oasis_filename(filename) else 'GDS2'
+            if format == 'OASIS':
+                library.write_oas(filename)
+            elif format == 'GDS2':
+                library.write_gds(filename)
+            else:
+                raise ValueError('gdstk cannot write {}'.format(format))
+        return gdstk_writer
+
+    def read_function(self, celltype):
+        import gdstk
+        def gdstk_reader(target, filename, *args, cellname=None, **kwargs):
+            if _is_oasis_filename(filename):
+                library = gdstk.read_oas(filename, *args, **kwargs)
+            else:
+                library = gdstk.read_gds(filename, *args, **kwargs)
+            if isinstance(target, gdstk.Library):
+                target.add(*library.cells)
+                return target
+            if cellname is None:
+                top_level_names = [cell.name for cell in library.top_level() if cell.name != gdsii.context_info_cellname]
+                if len(top_level_names) == 1:
+                    cellname = top_level_names[0]
+                else:
+                    raise ValueError('There are multiple top level cells: {}.\n Please specify with the cellname argument.'.format(top_level_names))
+            matches = [cell for cell in library.cells if cell.name == cellname]
+            if not matches:
+                raise ValueError('There is no cell named {}'.format(cellname))
+            topcell = matches[0]
+            # Transfer the contents of the imported cell to the one specified. The referenced cells come along
+            target.name = topcell.name
+            target.add(*topcell.polygons, *topcell.paths, *topcell.references, *topcell.labels)
+            return target
+        return gdstk_reader
+
+    def formats(self, celltype):
+        return ('OASIS', 'GDS2')
+
+
+def _read_pya_subtree(pya_cell, filename, cellname):
+    ''' Reads only cellname and the cells under it into pya_cell.
+
+        For GDS, the other cells are skipped by gdsii.subtree before klayout sees the file (klayout >= 0.29.9).
+        The sub-tree is read straight into the layout of pya_cell. Then its top cell's shapes and instances are moved into pya_cell.
+        If the database units differ, or the file is OASIS, it goes through a temporary layout instead.
+    '''
+    import pya
+    layout = pya_cell.layout()
+    if isinstance(filename, str):
+        with open(filename, 'rb') as fx:
+            is_gds = gdsii.is_gdsii(fx.read(4))
+    else:
+        position = filename.tell()
+        is_gds = gdsii.is_gdsii(filename.read(4))
+        filename.seek(position)
+
+    data = None
+    if is_gds and hasattr(pya.Layout, 'read_bytes'):
+        data = gdsii.subtree(filename, cellname)
+        if gdsii.database_unit(data) == round(layout.dbu, 12):
+            old_cells = set(cell.cell_index() for cell in layout.each_cell())
+            options = pya.LoadLayoutOptions()
+            options.cell_conflict_resolution = pya.LoadLayoutOptions.RenameCell
+            layout.read_bytes(data, options)
+            new_top = [cell for cell in layout.each_cell()
+                       if cell.cell_index() not in old_cells and cell.parent_cells() == 0][0]
+            pya_cell.move_shapes(new_top)
+            pya_cell.move_instances(new_top)
+            layout.delete_cell(new_top.cell_index())
+            pya_cell.name = cellname
+            return pya_cell
+
+    templayout = pya.Layout()
+    if data is not None:
+        templayout.read_bytes(data)
+    elif isinstance(filename, str):
+        templayout.read(filename)
+    else:
+        templayout.read_bytes(filename.read())
+    tempcell = templayout.cell(cellname)
+    if tempcell is None:
+        raise ValueError('There is no cell named {}'.format(cellname))
+    pya_cell.name = cellname
+    pya_cell.copy_tree(tempcell)
+    return pya_cell
+
+
+def _is_oasis_filename(filename):
+    return os.path.splitext(str(filename))[1].lower() in ('.oas', '.oasis')
+
+
+_backends = []
+_backend_celltypes = {}  # backend -> its celltypes, once it has been looked at
+_dispatch_cache = {}  # (what, celltype) -> backend, write function, or read function
+
+
+def register_backend(backend, first=False):
+    ''' Adds a Backend instance. It takes priority over the ones already registered if first is True.
+    '''
+    if first:
+        _backends.insert(0, backend)
+    else:
+        _backends.append(backend)
+    _dispatch_cache.clear()
+
+
+def registered_backends():
+    return list(_backends)
+
+
+register_backend(PyaBackend())
+register_backend(PhidlBackend())
+register_backend(GdstkBackend())
+
+
+def celltype_to_backend(celltype):
+    ''' The registered Backend that handles this class of layout Cell, or None
+    '''
+    if type(celltype) is not type:
+        celltype = type(celltype)
+    try:
+        return _dispatch_cache['backend', celltype]
+    except KeyError:
+        pass
+    found = None
+    for backend in _backends:
+        if backend.module not in sys.modules:
+            continue
+        if backend not in _backend_celltypes:
+            try:
+                _backend_celltypes[backend] = backend.celltypes()
+            except ImportError:
+                _backend_celltypes[backend] = ()
+        if issubclass(celltype, _backend_celltypes[backend]):
+            found = backend
+            break
+    _dispatch_cache['backend', celltype] = found
+    return found
+
+
+def _cached_function(what, celltype):
+    if type(celltype) is not type:
+        celltype = type(celltype)
+    try:
+        return _dispatch_cache[what, celltype]
+    except KeyError:
+        pass
+    backend = celltype_to_backend(celltype)
+    function = None
+    if backend is not None:
+        function = getattr(backend, what)(celltype)
+    if function is None:
+        raise TypeError('celltype: {} is not recognized as a layout cell object that can be {}.\n'.format(
+                            celltype.__name__, 'written' if what == 'write_function' else 'read into')
+                        + 'Registered languages are: {}'.format(', '.join(b.name for b in _backends)))
+    _dispatch_cache[what, celltype] = function
+    return function
+
+
+def celltype_to_write_function(celltype):
+    ''' Takes a class that represents a layout Cell and gives a function that writes its geometry to disc
+        (there is always some version of this, although some languages don't explicitly call it Cell)
+
+        The function comes from the registered Backend of that class.
+        Backends import their language on-the-fly because not everybody is going to have every language installed.
+        But if they don't, then their celltype is not going to be from that language.
+    '''
+    return _cached_function('write_function', celltype)
+
+
+def _check_gds_only(format, language_name):
+    if format not in (None, 'GDS2'):
+        raise ValueError('{} can only write GDS2, not {}'.format(language_name, format))
+
+
+def any_write(cell, *args, **kwargs):
+    write = celltype_to_write_function(cell)
+    return write(cell, *args, **kwargs)
+
+
+def celltype_to_read_function(celltype):
+    ''' Takes a class that represents a layout Cell and gives a function that reads geometry into it.
+    '''
+    return _cached_function('read_function', celltype)
 
 
 def any_read(cell, *args, **kwargs):
@@ -184,7 +428,102 @@ def any_read(cell, *args, **kwargs):
     return read(cell, *args, **kwargs)
 
 
-def anyCell_to_anyCell(initial_cell, final_cell):
+def celltype_supports_streams(celltype):
+    ''' Whether the read and write functions of this celltype can work with binary streams instead of filenames.
+    '''
+    if type(celltype) is not type:
+        celltype = type(celltype)
+    backend = celltype_to_backend(celltype)
+    return backend is not None and backend.supports_streams(celltype)
+
+
+def celltype_to_formats(celltype):
+    ''' The intermediate file formats that this celltype can both write and read, in order of preference.
+    '''
+    if type(celltype) is not type:
+        celltype = type(celltype)
+    backend = celltype_to_backend(celltype)
+    if backend is None:
+        return ('GDS2',)
+    return backend.formats(celltype)
+
+
+format_suffixes = {'GDS2': '.gds', 'OASIS': '.oas'}
+
+
+def intermediate_format(initial_celltype, final_celltype):
+    ''' Negotiates the file format used to go from initial to final.
+        It is the first of the writer's preferences that the reader also supports. GDS2 is the last resort.
+    '''
+    readable = celltype_to_formats(final_celltype)
+    for format in celltype_to_formats(initial_celltype):
+        if format in readable:
+            return format
+    return 'GDS2'
+
+
+def celltypes_to_direct_function(initial_celltype, final_celltype):
+    ''' Takes the classes of an initial and final layout Cell and gives a function that
+        converts one into the other object-to-object, without going through GDS.
+        Returns None if there is no such function for this pair. Then you have to use the write/read functions.
+    '''
+    if type(initial_celltype) is not type:
+        initial_celltype = type(initial_celltype)
+    if type(final_celltype) is not type:
+        final_celltype = type(final_celltype)
+    try:
+        return _dispatch_cache['direct', initial_celltype, final_celltype]
+    except KeyError:
+        pass
+    function = _find_direct_function(initial_celltype, final_celltype)
+    _dispatch_cache['direct', initial_celltype, final_celltype] = function
+    return function
+
+
+def _find_direct_function(initial_celltype, final_celltype):
+    backend_names = set()
+    for celltype in [initial_celltype, final_celltype]:
+        backend = celltype_to_backend(celltype)
+        if backend is not None:
+            backend_names.add(backend.name)
+    if backend_names != {'pya', 'phidl'}:
+        return None
+    import pya
+    import phidl
+
+    if (issubclass(initial_celltype, (phidl.Device, phidl.device_layout.DeviceReference))
+            and issubclass(final_celltype, pya.Cell)):
+        def phidlDevice_to_pyaCell(device, pya_cell, port_layer=None, incremental=False):
+            # If its a reference, use its parent
+            if isinstance(device, phidl.device_layout.DeviceReference):
+                device = device.parent
+            if port_layer is None:
+                port_layer = default_phidl_portlayer
+            phidl2pya(pya_cell, device, port_layer=port_layer, incremental=incremental)
+            pya_cell.name = 'toplevel'  # same as what comes out of phidl's write_gds
+            return pya_cell
+        return phidlDevice_to_pyaCell
+
+    if (issubclass(initial_celltype, pya.Cell)
+            and issubclass(final_celltype, phidl.Device)):
+        def pyaCell_to_phidlDevice(pya_cell, phidl_device, port_layer=None, incremental=False):
+            # incremental is ignored: the whole Device is rebuilt
+            if port_layer is None:
+                port_layer = default_phidl_portlayer
+            tempdevice = pya2phidl(phidl.Device(), pya_cell, port_layer=port_layer)
+            # copy over from temporary device, same as phidlDevice_reader
+            phidl_device.polygons = tempdevice.polygons
+            phidl_device.references = tempdevice.references
+            phidl_device.ports = tempdevice.ports
+            phidl_device.labels = tempdevice.labels
+            phidl_device.name = tempdevice.name
+            return phidl_device
+        return pyaCell_to_phidlDevice
+
+    return None
+
+
+def anyCell_to_anyCell(initial_cell, final_cell, in_memory=True, direct=True, cache=None, format=None, incremental=False):
     ''' Transfers the geometry of some initial_cell into another format.
         This initial_cell can be any type of layout object in any supported language.
 
@@ -194,23 +533,366 @@ def anyCell_to_anyCell(initial_cell, final_cell):
         final_cell must provide a way to read geometry in from a file.
 
         The supported types and their mapping to write methods are contained in celltype_to_write_function and celltype_to_read_function.
+
+        If direct is True and there is an object-to-object converter for these two cell types, GDS is skipped altogether.
+        If in_memory is True and both cell types support it, the GDS goes through a memory buffer instead of a temporary file.
+        Otherwise, it falls back to a temporary file in a fresh temporary directory, so concurrent calls never collide.
+        The format of that GDS is negotiated by intermediate_format (OASIS if both sides can), unless you specify format.
+
+        If incremental is True, phidl to pya translations only rebuild the subcells that changed
+        since the last incremental translation into the same layout (see phidl2pya). Other pairs ignore it.
+
+        cache can be a TranslationCache, or True to use the module-level translation_cache.
+        Then, if geometrically identical cells have been translated to the same type before, the result is copied from there.
+    '''
+    with profiling.record('anyCell_to_anyCell'):
+        if cache is True:
+            cache = translation_cache
+        source_hash = None
+        if cache is not None:
+            with profiling.phase('cache'):
+                source_hash = hash_geometry(initial_cell)
+                if source_hash is not None:
+                    key = (source_hash, type(final_cell), _target_dbu(final_cell))
+                    hit = cache.lookup(key, final_cell)
+                    if hit is not None:
+                        return hit
+
+        new_cell = None
+        if direct:
+            convert = celltypes_to_direct_function(initial_cell, final_cell)
+            if convert is not None:
+                with profiling.phase('direct'):
+                    new_cell = convert(initial_cell, final_cell, incremental=incremental)
+
+        if new_cell is None:
+            if format is None:
+                format = intermediate_format(initial_cell, final_cell)
+            if in_memory and celltype_supports_streams(initial_cell) and celltype_supports_streams(final_cell):
+                buffer = io.BytesIO()
+                with profiling.phase('write'):
+                    any_write(initial_cell, buffer, format=format, write_ports=True)
+                buffer.seek(0)
+                with profiling.phase('read'):
+                    new_cell = any_read(final_cell, buffer)
+            else:
+                with tempfile.TemporaryDirectory(prefix='lygadgets_') as scratch:
+                    scratch_file = os.path.join(scratch, 'cellTranslation' + format_suffixes[format])
+                    with profiling.phase('write'):
+                        any_write(initial_cell, scratch_file, format=format, write_ports=True)
+                    with profiling.phase('read'):
+                        new_cell = any_read(final_cell, scratch_file)
+
+        # Transfer other data (ports, metadata, CML files, etc.)
+        pass  # TODO
+
+        if source_hash is not None:
+            with profiling.phase('cache'):
+                cache.insert(key, new_cell)
+        return new_cell
+
+def hash_geometry(cell):
+    ''' SHA1 hex digest of the geometry of any supported layout cell, including its hierarchy.
+        Returns None if the cell type is not supported.
+
+        Each unique cell is hashed once, and its hash goes into the hashes of the cells that reference it,
+        so the cost grows with the number of unique cells and shapes, not with the flattened count.
+
+        phidl: _phidl_fingerprints, including Ports, labels, and Device names.
+        pya: _pya_fingerprints, plus the database unit. Cell names do not matter, since klayout often adds $N to them.
+    '''
+    celltype = type(cell)
+
+    try: import pya
+    except ImportError: pass
+    else:
+        if issubclass(celltype, pya.Cell):
+            layout = cell.layout()
+            final_hash = hashlib.sha1(repr(layout.dbu).encode())
+            final_hash.update(_pya_fingerprints(cell)[cell.cell_index()].encode())
+            return final_hash.hexdigest()
+
+    try: import phidl
+    except ImportError: pass
+    else:
+        if issubclass(celltype, (phidl.Device, phidl.device_layout.DeviceReference)):
+            if issubclass(celltype, phidl.device_layout.DeviceReference):
+                cell = cell.parent
+            return _phidl_fingerprints(cell, port_layer=default_phidl_portlayer)[id(cell)][1]
+
+    return None
+
+
+def _pya_fingerprints(cell):
+    ''' SHA1 digests of cell and every cell below it, keyed by cell index.
+        Each one covers the cell's own shapes (sorted within each layer, so insertion order does not matter)
+        and its instances, with the digests of the instantiated cells. Not the cell names.
+    '''
+    layout = cell.layout()
+    layer_infos = sorted(((layout.get_info(li), li) for li in layout.layer_indexes()),
+                         key=lambda item: (item[0].layer, item[0].datatype, item[0].name))
+    below = set(cell.called_cells())
+    below.add(cell.cell_index())
+    fingerprints = dict()
+    for cell_index in layout.each_cell_bottom_up():
+        if cell_index not in below:
+            continue
+        subcell = layout.cell(cell_index)
+        hasher = hashlib.sha1()
+        for info, li in layer_infos:
+            shapes = subcell.shapes(li)
+            if shapes.is_empty():
+                continue
+            hasher.update(str(info).encode())
+            for item in sorted(str(shape) for shape in shapes.each()):
+                hasher.update(item.encode())
+        instances = []
+        for inst in subcell.each_inst():
+            cell_inst = inst.cell_inst  # its str has the cell index in it, which is not geometry
+            instances.append('{} {} {} {} {} {}'.format(fingerprints[inst.cell_index], cell_inst.cplx_trans,
+                                                        cell_inst.a, cell_inst.b, cell_inst.na, cell_inst.nb))
+        for item in sorted(instances):
+            hasher.update(item.encode())
+        fingerprints[cell_index] = hasher.hexdigest()
+    return fingerprints
+
+
+class TranslationCache(LRUCache):
+    ''' Keeps results of anyCell_to_anyCell, keyed by hash_geometry of the initial cell plus the type of the final cell,
+        and its database unit if it has one.
+
+        pya results are kept as cells in private layouts, one per database unit, so nothing is snapped to another grid.
+        They are copy_tree'd into the final cell on a hit.
+        phidl results are kept as deep copies. On a hit, the final Device gets copies of the top-level elements,
+        but the sub-Devices are shared between hits, so don't modify those in place.
+    '''
+    def __init__(self, maxsize=128):
+        super().__init__(maxsize)
+        self._layouts = dict()  # rounded dbu -> pya.Layout
+
+    def _layout_for(self, dbu):
+        dbu_key = round(dbu, 12)
+        if dbu_key not in self._layouts:
+            import pya
+            layout = pya.Layout()
+            layout.dbu = dbu
+            self._layouts[dbu_key] = layout
+        return self._layouts[dbu_key], dbu_key
+
+    def _store(self, value):
+        import pya
+        if isinstance(value, pya.Cell):
+            layout, dbu_key = self._layout_for(value.layout().dbu)
+            cached_cell = layout.create_cell(value.name)
+            cached_cell.copy_tree(value)
+            return ('pya', cached_cell.cell_index(), value.name, dbu_key)
+        import phidl
+        if isinstance(value, phidl.Device):
+            return ('phidl', copy.deepcopy(value))
+        raise TypeError('TranslationCache cannot store {}'.format(type(value).__name__))
+
+    def _retrieve(self, entry, final_cell):
+        if entry[0] == 'pya':
+            _, cell_index, name, dbu_key = entry
+            final_cell.copy_tree(self._layouts[dbu_key].cell(cell_index))
+            final_cell.name = name
+        else:
+            _copy_phidl_toplevel(entry[1], final_cell)
+        return final_cell
+
+    def _discard(self, entry):
+        if entry[0] == 'pya':
+            self._layouts[entry[3]].prune_cell(entry[1], -1)
+
+
+translation_cache = TranslationCache()
+
+
+def _target_dbu(cell):
+    ''' The database unit of a pya cell's layout, None for other cell types '''
+    layout = getattr(cell, 'layout', None)
+    if callable(layout):
+        try:
+            return round(layout().dbu, 12)
+        except AttributeError:
+            return None
+    return None
+
+
+def _copy_phidl_toplevel(source, target):
+    ''' Gives target copies of the polygons, references, ports, and labels of source. Sub-Devices are shared. '''
+    import phidl
+    target.name = source.name
+    target.polygons = []
+    target.references = []
+    target.labels = []
+    target.ports = dict()
+    for poly in source.polygons:
+        target.add_polygon(poly)
+    for ref in source.references:
+        transform = dict(origin=ref.origin, rotation=ref.rotation,
+                         magnification=ref.magnification, x_reflection=ref.x_reflection)
+        if isinstance(ref, phidl.device_layout.CellArray):
+            new_ref = phidl.device_layout.CellArray(ref.parent, columns=ref.columns, rows=ref.rows, spacing=ref.spacing, **transform)
+        else:
+            new_ref = phidl.device_layout.DeviceReference(ref.parent, **transform)
+        new_ref.owner = target
+        target.add(new_ref)
+    for port in source.ports.values():
+        target.add_port(port=port)
+    for label in source.labels:
+        new_label = target.add_label(text=label.text, position=label.position,
+                                     magnification=label.magnification, rotation=label.rotation,
+                                     layer=(label.layer, label.texttype))
+        new_label.anchor = label.anchor
+    return target
+
+
+def _cell_name(cell):
+    name = getattr(cell, 'name', None)
+    if name is None:  # e.g. a DeviceReference
+        name = getattr(getattr(cell, 'parent', None), 'name', None)
+    return name or 'cell'
+
+
+def _unique_names(cells):
+    used = set()
+    counts = dict()  # base name -> last suffix tried
+    names = []
+    for cell in cells:
+        base = name = _cell_name(cell)
+        count = counts.get(base, 0)
+        while name in used:
+            count += 1
+            name = '{}${}'.format(base, count)
+        counts[base] = count
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def _build_library(cells, names):
+    ''' Puts every cell into its own top cell of one new pya.Layout, named by names.
+        Returns that layout and the names.
     '''
-    global do_write_ports
-    do_write_ports_orig = do_write_ports
-    do_write_ports = True
-    tempfile = os.path.expanduser('~/temp_cellTranslation.gds')
-    any_write(initial_cell, tempfile)
-    new_cell = any_read(final_cell, tempfile)
-    os.remove(tempfile)
-    do_write_ports = do_write_ports_orig
+    import pya
+    library = pya.Layout()
+    # Claim the top cell names before any subcells get made
+    lib_cells = iter([library.create_cell(name) for name in names])
+    _translate_together(cells, names, lambda: next(lib_cells))
+    return library, names
 
-    # Transfer other data (ports, metadata, CML files, etc.)
-    pass  # TODO
 
-    return new_cell
+def _process_pool_map(function, processes, *iterables):
+    ''' list(map(function, *iterables)) in a pool of processes, started with pcell_worker.process_pool '''
+    from lygadgets.pcell_worker import process_pool
+    pool = None
+    try:
+        pool = process_pool(processes)
+        return list(pool.map(function, *iterables))
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
 
-def phidl2pya_flat(cell, device):
+def _library_bytes(cells, names):
+    ''' Runs in worker processes of translate_many. '''
+    import pya
+    library, names = _build_library(cells, names)
+    options = pya.SaveLayoutOptions()
+    options.format = 'OASIS'  # lots of repetition in a component library
+    return library.write_bytes(options), names
+
+
+def _translate_together(cells, names, target_factory):
+    ''' The last step of translate_many. Each unique subcell is translated once per final layout, not once per cell:
+        phidl->pya and pya->phidl share a map of the subcells that were built so far,
+        and pya->pya copies every group of cells from one layout into another at once, with one CellMapping.
+        Within one layout, pya->pya copies just the top cells, with instances of the same subcells.
+        Other pairs go one by one through anyCell_to_anyCell.
+    '''
+    import pya
+    try:
+        import phidl
+        device_types = (phidl.Device, phidl.device_layout.DeviceReference)
+    except ImportError:
+        phidl, device_types = None, ()
+    final_cells = [target_factory() for _ in cells]
+    shared_maps = dict()  # id of the layout being built or read -> map for phidl2pya or pya2phidl
+    pya_groups = dict()  # (id of source layout, id of final layout) -> [(source cell, final cell)]
+    for cell, final_cell in zip(cells, final_cells):
+        if isinstance(cell, device_types) and isinstance(final_cell, pya.Cell):
+            if isinstance(cell, phidl.device_layout.DeviceReference):
+                cell = cell.parent
+            phidl2pya(final_cell, cell, port_layer=default_phidl_portlayer,
+                      device_to_cell=shared_maps.setdefault(id(final_cell.layout()), dict()))
+        elif isinstance(cell, pya.Cell) and phidl is not None and isinstance(final_cell, phidl.Device):
+            pya2phidl(final_cell, cell, port_layer=default_phidl_portlayer,
+                      cell_to_device=shared_maps.setdefault(id(cell.layout()), dict()))
+        elif isinstance(cell, pya.Cell) and isinstance(final_cell, pya.Cell):
+            pya_groups.setdefault((id(cell.layout()), id(final_cell.layout())), []).append((cell, final_cell))
+        else:
+            anyCell_to_anyCell(cell, final_cell)
+    for pairs in pya_groups.values():
+        source_layout = pairs[0][0].layout()
+        final_layout = pairs[0][1].layout()
+        if source_layout is final_layout:  # the subcells are already there to be used
+            for cell, final_cell in pairs:
+                final_cell.copy_shapes(cell)
+                final_cell.copy_instances(cell)
+            continue
+        cell_mapping = pya.CellMapping()
+        cell_mapping.for_multi_cells_full(final_layout, [final_cell.cell_index() for _, final_cell in pairs],
+                                          source_layout, [cell.cell_index() for cell, _ in pairs])
+        final_layout.copy_tree_shapes(source_layout, cell_mapping)
+    for final_cell, name in zip(final_cells, names):
+        final_cell.name = name
+    return final_cells
+
+
+def translate_many(cells, target_factory, processes=None, chunksize=None):
+    ''' Translates a lot of cells at once, for example a whole component library.
+
+        target_factory is called with no arguments to make each empty final cell, like Device or lambda: layout.create_cell('x').
+        Returns the list of final cells, in the same order as cells. They are named after the initial cells, made unique.
+
+        Subcells that the cells have in common are translated once, and they stay shared by the final cells
+        (if these are in the same pya.Layout). Between phidl and pya, that is where the time is saved:
+        cells with nothing in common take about as long as translating them one by one.
+        Other cell types are just translated one by one.
+
+        With processes > 1, the cells are split into chunks. Each chunk is built into a multi-top-cell pya library in a worker process,
+        written once as OASIS, read once back here, and then split out into the final cells.
+        Then cells must be picklable, which phidl Devices are, but pya Cells are not.
+        The pool is started like pregenerate_pcells does it.
+    '''
+    import pya
+    cells = list(cells)
+    names = _unique_names(cells)
+    if processes is None or processes <= 1 or len(cells) <= 1:
+        return _translate_together(cells, names, target_factory)
+
+    if any(isinstance(cell, pya.Cell) for cell in cells):
+        raise TypeError('pya.Cells cannot be sent to other processes. Use processes=None.')
+    if chunksize is None:
+        chunksize = -(-len(cells) // processes)
+    starts = range(0, len(cells), chunksize)
+    streams = _process_pool_map(_library_bytes, processes,
+                                [cells[i:i + chunksize] for i in starts],
+                                [names[i:i + chunksize] for i in starts])
+    lib_cells = []
+    lib_names = []
+    libraries = []  # keeps them alive
+    for stream, chunk_names in streams:
+        library = pya.Layout()
+        library.read_bytes(stream, pya.LoadLayoutOptions())
+        libraries.append(library)
+        lib_cells.extend(library.cell(name) for name in chunk_names)
+        lib_names.extend(chunk_names)
+    return _translate_together(lib_cells, lib_names, target_factory)
+
+
+def phidl2pya_flat(cell, device, batched=False):
     ''' Inserts polygons from a phidl device into an existing pya cell.
         It is simpler than going through GDS, but it is rudimentary.
         No positioning control. No cell references: auto-flatten.
@@ -220,15 +902,24 @@ def phidl2pya_flat(cell, device):
             Cel = pya.Layout().create_cell('name')
             Dev = phidl.geometry.rectangle((10, 10))
             phidl2pya_flat(Cel, Dev)
+
+        For devices with a lot of polygons, use batched=True.
+        Then polygons are grouped by (layer, datatype), snapped to the layout dbu all at once,
+        and inserted in bulk (see _insert_polygons_batched). The device is not flattened in place.
     '''
     import pya
-    device = device.flatten()
-    for container in device.polygons:
-        for lay, dtyp, shape in zip(container.layers, container.datatypes, container.polygons):
-            pya_layer = cell.layout().layer(lay, dtyp)
-            poly_dpts = [pya.DPoint(*f) for f in shape]
-            dpoly = pya.DSimplePolygon(poly_dpts)
-            dpoly.layout(cell, pya_layer)
+    import numpy as np
+    if batched:
+        # no need to flatten the device itself: gdspy gives the flattened polygons already grouped
+        _insert_polygons_batched(cell, device.get_polygons(by_spec=True))
+    else:
+        device = device.flatten()
+        for container in device.polygons:
+            for lay, dtyp, shape in zip(container.layers, container.datatypes, container.polygons):
+                pya_layer = cell.layout().layer(lay, dtyp)
+                poly_dpts = [pya.DPoint(x, y) for x, y in np.asarray(shape, dtype=float).tolist()]
+                dpoly = pya.DSimplePolygon(poly_dpts)
+                cell.shapes(pya_layer).insert(dpoly)
     try:
         from zeropdk.pcell import Port
     except ImportError:
@@ -240,3 +931,515 @@ def phidl2pya_flat(cell, device):
             pyapo = Port(nam, pya.DPoint(*po.midpoint), normal_vec, po.width)
             ports.append(pyapo)
         return ports
+
+
+def _insert_polygons_batched(cell, polygons_by_spec):
+    ''' Inserts polygons into a pya cell, one (layer, datatype) group at a time.
+        polygons_by_spec is a dict of (layer, datatype) -> list of point arrays, like phidl's get_polygons(by_spec=True).
+
+        Coordinates are snapped to integer database units with one numpy operation per group.
+        When klayout can read bytes, each group goes in as raw GDSII BOUNDARY records, read into a scratch layout
+        and moved into the cell from there, so that no pya.Point is ever made in python. Otherwise, each group is inserted as one pya.Region.
+    '''
+    import pya
+    import numpy as np
+    from lygadgets import gdsii
+    layout = cell.layout()
+    use_gds = hasattr(pya.Layout, 'read_bytes')
+    gds_body = []
+    for (lay, dtyp), shapes in polygons_by_spec.items():
+        if len(shapes) == 0:
+            continue
+        lengths = np.array([len(shape) for shape in shapes])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        points = np.round(np.concatenate(shapes) / layout.dbu).astype(np.int64)
+        leftovers = np.ones(len(shapes), dtype=bool)
+        if use_gds:
+            # polygons with the same number of vertices are done in one shot
+            for nvert in np.unique(lengths):
+                if nvert + 1 > gdsii.max_boundary_points:
+                    continue
+                which = np.nonzero(lengths == nvert)[0]
+                group_points = points[starts[which, None] + np.arange(nvert)]
+                gds_body.append(gdsii.boundary_records(lay, dtyp, group_points))
+                leftovers[which] = False
+        if np.any(leftovers):
+            region = pya.Region()
+            points_list = points.tolist()
+            for start, nvert in zip(starts[leftovers].tolist(), lengths[leftovers].tolist()):
+                region.insert(pya.SimplePolygon([pya.Point(x, y) for x, y in points_list[start:start + nvert]]))
+            cell.shapes(layout.layer(lay, dtyp)).insert(region)
+
+    if len(gds_body) > 0:
+        # Cell names are not unique in klayout, so the records go into a scratch layout, not into cell by name
+        stream = b''.join([gdsii.library_header(layout.dbu), gdsii.structure_header('batched')]
+                          + gds_body
+                          + [gdsii.structure_footer(), gdsii.library_footer()])
+        scratch = pya.Layout()
+        scratch.read_bytes(stream)
+        cell.move_shapes(scratch.cell('batched'))
+
+
+def _phidl_cells_bottom_up(device):
+    ''' Every Device in the hierarchy exactly once, children before their parents '''
+    order = []
+    seen = {id(device)}
+    stack = [(device, iter(device.references))]
+    while stack:
+        cell, references = stack[-1]
+        for ref in references:
+            child = ref.ref_cell
+            if id(child) not in seen:
+                seen.add(id(child))
+                stack.append((child, iter(child.references)))
+                break
+        else:
+            stack.pop()
+            order.append(cell)
+    return order
+
+
+def write_phidl_streaming(device, filename, unit=1e-6, precision=1e-9, auto_rename=True, max_cellname_length=28,
+                          cellname='toplevel', port_layer=None, write_ports=True, progress=None):
+    ''' Writes a phidl Device to GDS one cell at a time, children before parents.
+        Use it through any_write(device, filename, streaming=True).
+
+        The result is the same as Device.write_gds, with ports converted to geometry like phidl's ports_to_geometry.
+        The difference is that the device is never copied: each port becomes a triangle and a label as its cell is written.
+        Besides the device itself, memory use is bounded by the largest single cell.
+
+        progress is called after each cell as progress(cells_done, cells_total, cellname).
+        If it is True, that goes to lygadgets.message.
+    '''
+    if progress is True:
+        from lygadgets.messaging import message
+        progress = lambda done, total, name: message('Wrote cell {} of {}: {}'.format(done, total, name))
+    if port_layer is None:
+        port_layer = default_phidl_portlayer
+    cells = _phidl_cells_bottom_up(device)
+    original_names = [cell.name for cell in cells]
+    if auto_rename:
+        # Fix duplicate names. Same as Device.write_gds
+        used_names = {cellname}
+        n = 1
+        for cell in sorted(cells, key=lambda c: c.uid):
+            if max_cellname_length is not None:
+                new_name = cell.name[:max_cellname_length]
+            else:
+                new_name = cell.name
+            temp_name = new_name
+            while temp_name in used_names:
+                n += 1
+                temp_name = new_name + ('%0.3i' % n)
+            used_names.add(temp_name)
+            cell.name = temp_name
+        device.name = cellname
+
+    multiplier = unit / precision
+    close = isinstance(filename, str)
+    outfile = open(filename, 'wb') if close else filename
+    try:
+        outfile.write(gdsii.library_header(precision * 1e6, libname='library', unit=unit))
+        for icell, cell in enumerate(cells):
+            outfile.write(gdsii.structure_header(cell.name))
+            # These are gdspy objects that write their own records
+            for element in cell.polygons + cell.paths + cell.labels + cell.references:
+                element.to_gds(outfile, multiplier)
+            if write_ports:
+                for port in cell.ports.values():
+                    port_device = _phidl_port_geometry(port, port_layer)
+                    if port_device is not None:
+                        for element in port_device.polygons + port_device.labels:
+                            element.to_gds(outfile, multiplier)
+            outfile.write(gdsii.structure_footer())
+            if progress is not None:
+                progress(icell + 1, len(cells), cell.name)
+        outfile.write(gdsii.library_footer())
+    finally:
+        if close:
+            outfile.close()
+        for cell, name in zip(cells, original_names):
+            cell.name = name
+    return filename
+
+
+def _phidl_port_geometry(port, layer):
+    ''' Gives a throwaway Device holding the geometric representation of a phidl Port (a triangle and a label).
+        The port and its parent are not modified. Returns None with older versions of phidl.
+    '''
+    import phidl
+    try:
+        port2geom = phidl.geometry._convert_port_to_geometry
+    except AttributeError:  # it is an older version of phidl
+        return None
+    holder = phidl.Device()
+    port_copy = port._copy()
+    port_copy.parent = holder
+    port2geom(port_copy, layer=layer)
+    return holder
+
+
+def phidl2pya(cell, device, port_layer=None, incremental=False, device_to_cell=None):
+    ''' Inserts the geometry of a phidl device into an existing pya cell, keeping the hierarchy.
+        Every unique Device becomes exactly one new pya.Cell in the layout of cell.
+        DeviceReferences and CellArrays become CellInstArrays pointing to those cells.
+        The top-level device goes into cell itself.
+
+        If port_layer is given, Ports are converted to geometry on that layer, just like phidl's ports_to_geometry,
+        except that the device is not copied to do so.
+
+        If incremental is True, cell is re-translated: its old contents are replaced.
+        Each Device gets a fingerprint of its own geometry and the fingerprints of what it references.
+        Subcells that have the same fingerprint as one from an earlier incremental translation into this layout are reused, not rebuilt.
+        Parents of changed subcells get new instances, and copy their own shapes from the old cell if those did not change.
+        Cells from earlier translations that nothing uses anymore are deleted.
+        Then the rebuilt cells take back their Device's name if it was only suffixed because the old cell still had it.
+
+        To translate several Devices into the same layout, pass the same dict as device_to_cell to each call.
+        Then sub-Devices they have in common become one cell. Not with incremental.
+
+            Cel = pya.Layout().create_cell('name')
+            Dev = phidl.geometry.rectangle((10, 10))
+            phidl2pya(Cel, Dev)
+    '''
+    import pya
+    import phidl
+    import numpy as np
+    layout = cell.layout()
+    layer_indices = dict()
+    def pya_layer(lay, dtyp):
+        lay, dtyp = int(lay), int(dtyp)
+        try:
+            return layer_indices[lay, dtyp]
+        except KeyError:
+            layer_indices[lay, dtyp] = layout.layer(lay, dtyp)
+            return layer_indices[lay, dtyp]
+
+    def insert_polygon(pya_cell, lay, dtyp, shape):
+        poly_dpts = [pya.DPoint(x, y) for x, y in np.asarray(shape, dtype=float).tolist()]
+        pya_cell.shapes(pya_layer(lay, dtyp)).insert(pya.DSimplePolygon(poly_dpts))
+
+    def insert_geometry(pya_cell, device):
+        for container in device.polygons:
+            for lay, dtyp, shape in zip(container.layers, container.datatypes, container.polygons):
+                insert_polygon(pya_cell, lay, dtyp, shape)
+        for path in getattr(device, 'paths', []):
+            for (lay, dtyp), shapes in path.get_polygons(by_spec=True).items():
+                for shape in shapes:
+                    insert_polygon(pya_cell, lay, dtyp, shape)
+        for label in device.labels:
+            rot90 = int(round((label.rotation or 0) / 90)) % 4
+            x0, y0 = np.asarray(label.position, dtype=float).tolist()
+            dtext = pya.DText(label.text, pya.DTrans(rot90, bool(label.x_reflection), x0, y0))
+            if label.magnification is not None:
+                dtext.size = float(label.magnification)
+            # gdspy stores the anchor like the GDS presentation: two bits horizontal, two bits vertical
+            dtext.halign = label.anchor & 3
+            dtext.valign = label.anchor >> 2
+            pya_cell.shapes(pya_layer(label.layer, label.texttype)).insert(dtext)
+
+    if incremental:
+        state = _incremental_states.setdefault(layout, _IncrementalState())
+        fingerprints = _phidl_fingerprints(device, port_layer)
+        renamed = []  # new cells that got a $N suffix because the cell they replace still had the name
+
+    if device_to_cell is None:
+        device_to_cell = dict()  # keyed by id, because Devices are not hashable in all versions of phidl
+    def build(device, pya_cell=None):
+        if pya_cell is None:
+            try:
+                return device_to_cell[id(device)]
+            except KeyError:
+                pass
+            if incremental:
+                pya_cell = state.cell(layout, 'cells', fingerprints[id(device)][1])
+                if pya_cell is not None:
+                    device_to_cell[id(device)] = pya_cell
+                    return pya_cell
+            pya_cell = layout.create_cell(device.name)
+            if incremental and pya_cell.name != device.name:
+                renamed.append((pya_cell, device.name))
+        device_to_cell[id(device)] = pya_cell
+        old_shapes = state.cell(layout, 'shapes', fingerprints[id(device)][0]) if incremental else None
+        if old_shapes is not None and old_shapes.cell_index() != pya_cell.cell_index():
+            pya_cell.copy_shapes(old_shapes)
+        elif old_shapes is None:
+            insert_geometry(pya_cell, device)
+            if port_layer is not None:
+                for port in device.ports.values():
+                    port_device = _phidl_port_geometry(port, port_layer)
+                    if port_device is not None:
+                        insert_geometry(pya_cell, port_device)
+        if incremental and pya_cell is not cell:
+            state.remember(pya_cell, *fingerprints[id(device)])
+
+        for ref in device.references:
+            child = build(ref.parent)
+            # numpy scalars are not accepted by pya, so everything goes through float
+            rotation = float(ref.rotation or 0)
+            magnification = float(ref.magnification or 1)
+            mirror = bool(ref.x_reflection)
+            x0, y0 = np.asarray(ref.origin, dtype=float).tolist()
+            trans = pya.DCplxTrans(magnification, rotation, mirror, x0, y0)
+            if isinstance(ref, phidl.device_layout.CellArray):
+                # spacing is not magnified, but it is reflected and rotated. Same as gdspy
+                rot = pya.DCplxTrans(1, rotation, False, 0, 0)
+                dx, dy = np.asarray(ref.spacing, dtype=float).tolist()
+                col_vec = rot * pya.DVector(dx, 0)
+                row_vec = rot * pya.DVector(0, -dy if mirror else dy)
+                inst = pya.DCellInstArray(child.cell_index(), trans, col_vec, row_vec, int(ref.columns), int(ref.rows))
+            else:
+                inst = pya.DCellInstArray(child.cell_index(), trans)
+            pya_cell.insert(inst)
+        return pya_cell
+
+    if not incremental:
+        return build(device, cell)
+
+    own, fingerprint = fingerprints[id(device)]
+    previous = state.targets.get(cell.cell_index())
+    if previous == (own, fingerprint):
+        return cell
+    cell.clear_insts()
+    if previous is None or previous[0] != own:
+        cell.clear_shapes()
+        state.shapes = {fp: entry for fp, entry in state.shapes.items() if entry[0] != cell.cell_index()}
+    else:
+        state.shapes[own] = (cell.cell_index(), cell.name)  # build keeps the shapes that are there
+    build(device, cell)
+    state.shapes[own] = (cell.cell_index(), cell.name)
+    state.targets[cell.cell_index()] = (own, fingerprint)
+    state.prune(layout)
+    for pya_cell, name in renamed:
+        if layout.cell(name) is None:
+            state.rename(pya_cell, name)
+    return cell
+
+
+class _IncrementalState(object):
+    ''' What earlier incremental phidl2pya calls built in one layout.
+        cells: fingerprint of a Device with its hierarchy -> (cell_index, name)
+        shapes: fingerprint of a Device's own geometry -> (cell_index, name)
+        targets: cell_index of a top cell -> (own fingerprint, full fingerprint)
+    '''
+    def __init__(self):
+        self.cells = dict()
+        self.shapes = dict()
+        self.targets = dict()
+
+    def cell(self, layout, which, fingerprint):
+        ''' The cell remembered for this fingerprint, if it is still there and has not been renamed '''
+        try:
+            cell_index, name = getattr(self, which)[fingerprint]
+        except KeyError:
+            return None
+        if layout.is_valid_cell_index(cell_index):
+            cell = layout.cell(cell_index)
+            if cell.name == name:
+                return cell
+        del getattr(self, which)[fingerprint]
+        return None
+
+    def remember(self, cell, own, fingerprint):
+        entry = (cell.cell_index(), cell.name)
+        self.cells[fingerprint] = entry
+        self.shapes[own] = entry
+
+    def rename(self, cell, name):
+        entry = (cell.cell_index(), cell.name)
+        cell.name = name
+        for remembered in (self.cells, self.shapes):
+            for fingerprint in [fp for fp, other in remembered.items() if other == entry]:
+                remembered[fingerprint] = (cell.cell_index(), name)
+
+    def prune(self, layout):
+        ''' Deletes the cells built by incremental translations that are no longer used by anything '''
+        built = set(entry[0] for entry in self.cells.values())
+        dropped = set()
+        while True:
+            unused = [index for index in built - dropped
+                      if layout.is_valid_cell_index(index)
+                      and index not in self.targets
+                      and layout.cell(index).parent_cells() == 0]
+            if not unused:
+                break
+            for index in unused:
+                layout.delete_cell(index)
+            dropped.update(unused)
+        self.cells = {fp: entry for fp, entry in self.cells.items() if entry[0] not in dropped}
+        self.shapes = {fp: entry for fp, entry in self.shapes.items() if entry[0] not in dropped}
+
+
+_incremental_states = weakref.WeakKeyDictionary()  # pya.Layout -> _IncrementalState
+
+
+def _phidl_fingerprints(device, port_layer=None):
+    ''' SHA1 digests for every Device in the hierarchy, keyed by id(Device).
+        Each one is a pair: (own geometry, own geometry plus the references and their fingerprints).
+        Like a Merkle tree, a change anywhere below a Device changes its second fingerprint.
+    '''
+    import numpy as np
+    fingerprints = dict()
+
+    def update_array(hasher, values):
+        values = np.asarray(values, dtype=float)
+        hasher.update(str(values.shape).encode())
+        hasher.update(values.tobytes())
+
+    for subdevice in _phidl_cells_bottom_up(device):
+        own = hashlib.sha1(subdevice.name.encode())
+        for container in subdevice.polygons:
+            update_array(own, container.layers)
+            update_array(own, container.datatypes)
+            for shape in container.polygons:
+                update_array(own, shape)
+        for path in getattr(subdevice, 'paths', []):
+            for spec, shapes in sorted(path.get_polygons(by_spec=True).items()):
+                update_array(own, spec)
+                for shape in shapes:
+                    update_array(own, shape)
+        for label in subdevice.labels:
+            own.update(repr((label.text, np.asarray(label.position, dtype=float).tolist(), label.rotation,
+                             label.magnification, label.x_reflection, label.anchor,
+                             label.layer, label.texttype)).encode())
+        if port_layer is not None:
+            own.update(repr(port_layer).encode())
+            for name, port in subdevice.ports.items():
+                own.update(repr((name, np.asarray(port.midpoint, dtype=float).tolist(),
+                                 float(port.width), float(port.orientation))).encode())
+        own = own.hexdigest()
+
+        full = hashlib.sha1(own.encode())
+        for ref in subdevice.references:
+            full.update(fingerprints[id(ref.ref_cell)][1].encode())
+            full.update(repr((np.asarray(ref.origin, dtype=float).tolist(), ref.rotation, ref.magnification,
+                              ref.x_reflection, getattr(ref, 'columns', None), getattr(ref, 'rows', None),
+                              np.asarray(getattr(ref, 'spacing', (0, 0)), dtype=float).tolist())).encode())
+        fingerprints[id(subdevice)] = (own, full.hexdigest())
+    return fingerprints
+
+
+def pya2phidl(device, cell, port_layer=None, cell_to_device=None):
+    ''' Inserts the geometry of a pya cell into an existing phidl Device, keeping the hierarchy.
+        The inverse of phidl2pya. Every cell in the tree becomes exactly one new Device.
+        Regular instance arrays become CellArrays, unless they are skewed, in which case they are expanded.
+        Boxes, paths, and polygons all become polygons. Holes are resolved.
+
+        If port_layer is given, geometry on that layer is converted into Ports, just like phidl's geometry_to_ports,
+        except that it happens while building, so the device is not copied.
+
+        To translate several cells of the same layout, pass the same dict as cell_to_device to each call.
+        Then subcells they have in common become one Device.
+
+            Dev = phidl.Device()
+            Cel = pya.Layout().create_cell('name')
+            pya2phidl(Dev, Cel)
+    '''
+    import pya
+    import phidl
+    import numpy as np
+    layout = cell.layout()
+    dbu = layout.dbu
+    layer_specs = [(li, layout.get_info(li)) for li in layout.layer_indexes()]
+
+    try:
+        geom2port = phidl.geometry._convert_geometry_to_port
+    except AttributeError:  # it is an older version of phidl
+        port_layer = None
+    if port_layer is not None:
+        port_layer = tuple(phidl.device_layout._parse_layer(port_layer))
+
+    def insert_geometry(device, pya_cell):
+        for li, info in layer_specs:
+            spec = (info.layer, info.datatype)
+            is_port_layer = (spec == port_layer)
+            polygons = []
+            for shape in pya_cell.shapes(li).each():
+                if shape.is_text():
+                    dtext = shape.dtext
+                    label = device.add_label(text=dtext.string,
+                                             position=(dtext.x, dtext.y),
+                                             magnification=dtext.size if dtext.size > 0 else None,
+                                             rotation=dtext.trans.angle,
+                                             layer=spec)
+                    # gdspy stores the anchor like the GDS presentation: two bits horizontal, two bits vertical
+                    halign, valign = [a.to_i() if hasattr(a, 'to_i') else int(a) for a in (dtext.halign, dtext.valign)]
+                    label.anchor = max(halign, 0) + 4 * max(valign, 0)
+                    if is_port_layer:
+                        the_port = geom2port(label)
+                        device.add_port(name=the_port.name, port=the_port)
+                        device.labels.remove(label)
+                elif not is_port_layer and (shape.is_box() or shape.is_polygon() or shape.is_simple_polygon() or shape.is_path()):
+                    poly = shape.polygon
+                    if poly.holes() > 0:
+                        poly = poly.resolved_holes()
+                    polygons.append(np.array([(pt.x, pt.y) for pt in poly.each_point_hull()]) * dbu)
+            if len(polygons) > 0:
+                device.add_polygon(polygons, layer=spec)
+
+    def add_reference(device, child, dtrans, origin=None):
+        if origin is None:
+            origin = dtrans.disp
+        ref = phidl.device_layout.DeviceReference(child,
+                                                  origin=(origin.x, origin.y),
+                                                  rotation=dtrans.angle,
+                                                  magnification=dtrans.mag if dtrans.mag != 1 else None,
+                                                  x_reflection=dtrans.is_mirror())
+        ref.owner = device
+        device.add(ref)
+
+    def add_array(device, child, dcell_inst):
+        dtrans = dcell_inst.cplx_trans
+        # In gdspy, the spacing is reflected and rotated, but not magnified. Undo that.
+        unrotate = pya.DCplxTrans(1, -dtrans.angle, False, 0, 0)
+        col_vec = unrotate * dcell_inst.a
+        row_vec = unrotate * dcell_inst.b
+        columns, rows = dcell_inst.na, dcell_inst.nb
+        tol = dbu / 2
+        if abs(col_vec.y) > tol or abs(row_vec.x) > tol:
+            if abs(col_vec.x) < tol and abs(row_vec.y) < tol:
+                # a and b are swapped
+                col_vec, row_vec = row_vec, col_vec
+                columns, rows = rows, columns
+            else:
+                # skewed array. phidl can't represent that
+                for ia in range(dcell_inst.na):
+                    for ib in range(dcell_inst.nb):
+                        offset = dcell_inst.a * ia + dcell_inst.b * ib
+                        add_reference(device, child, dtrans, origin=dtrans.disp + offset)
+                return
+        if dtrans.is_mirror():
+            # after the swap: klayout stores mirrored arrays from GDS and OASIS with a and b swapped
+            row_vec.y = -row_vec.y
+        ref = phidl.device_layout.CellArray(child,
+                                            columns=columns, rows=rows,
+                                            spacing=(col_vec.x, row_vec.y),
+                                            origin=(dtrans.disp.x, dtrans.disp.y),
+                                            rotation=dtrans.angle,
+                                            magnification=dtrans.mag if dtrans.mag != 1 else None,
+                                            x_reflection=dtrans.is_mirror())
+        ref.owner = device
+        device.add(ref)
+
+    if cell_to_device is None:
+        cell_to_device = dict()
+    def build(pya_cell, device=None):
+        if device is None:
+            try:
+                return cell_to_device[pya_cell.cell_index()]
+            except KeyError:
+                device = phidl.Device(pya_cell.name)
+        else:
+            device.name = pya_cell.name
+        cell_to_device[pya_cell.cell_index()] = device
+        insert_geometry(device, pya_cell)
+        for inst in pya_cell.each_inst():
+            child = build(inst.cell)
+            dcell_inst = inst.dcell_inst
+            if dcell_inst.is_regular_array():
+                add_array(device, child, dcell_inst)
+            else:
+                add_reference(device, child, dcell_inst.cplx_trans)
+        return device
+
+    return build(cell, device)
@@ -0,0 +1,255 @@
+''' Raw GDSII stream records, without going through any layout language.
+
+    This is for the places where going through pya or gdspy objects one-by-one is too slow,
+    for example inserting millions of polygons at once, or finding the top cell of a huge file.
+    It is not a general GDS reader/writer. Use klayout for that.
+
+    Record format: 2 bytes total length (including the header), 1 byte record type, 1 byte data type, then the data.
+'''
+import struct
+import math
+import mmap
+import contextlib
+from collections import OrderedDict
+import numpy as np
+
+# record types
+HEADER = 0x00
+BGNLIB = 0x01
+LIBNAME = 0x02
+UNITS = 0x03
+ENDLIB = 0x04
+BGNSTR = 0x05
+STRNAME = 0x06
+ENDSTR = 0x07
+BOUNDARY = 0x08
+SREF = 0x0A
+AREF = 0x0B
+LAYER = 0x0D
+DATATYPE = 0x0E
+XY = 0x10
+ENDEL = 0x11
+SNAME = 0x12
+
+# data types
+NO_DATA = 0x00
+INT16 = 0x02
+INT32 = 0x03
+REAL64 = 0x05
+ASCII = 0x06
+
+# A polygon in one XY record cannot be longer than this, including the closing point
+max_boundary_points = (0xFFFF - 4) // 8
+
+
+def _eight_byte_real(value):
+    ''' GDSII excess-64, base-16 floating point. Same as gdspy '''
+    if value == 0:
+        return b'\x00' * 8
+    sign = 0x00
+    if value < 0:
+        sign = 0x80
+        value = -value
+    fexp = math.log2(value) / 4
+    exponent = int(math.ceil(fexp))
+    if fexp == exponent:
+        exponent += 1
+    mantissa = int(value * 16.0 ** (14 - exponent))
+    return bytes([sign + exponent + 64]) + mantissa.to_bytes(7, 'big')
+
+
+def _from_eight_byte_real(data):
+    sign = -1 if data[0] & 0x80 else 1
+    exponent = (data[0] & 0x7F) - 64
+    mantissa = int.from_bytes(data[1:8], 'big')
+    return sign * mantissa * 16.0 ** (exponent - 14)
+
+
+def record(rectype, datatype, payload=b''):
+    return struct.pack('>HBB', 4 + len(payload), rectype, datatype) + payload
+
+
+def ascii_record(rectype, text):
+    payload = text.encode('ascii')
+    if len(payload) % 2 != 0:
+        payload += b'\0'
+    return record(rectype, ASCII, payload)
+
+
+def library_header(dbu, libname='LIB', unit=1e-6):
+    ''' dbu is in microns, like klayout's Layout.dbu. unit is the user unit in meters, like gdspy's GdsLibrary.unit '''
+    return (record(HEADER, INT16, struct.pack('>h', 600))
+            + record(BGNLIB, INT16, b'\0' * 24)
+            + ascii_record(LIBNAME, libname)
+            + record(UNITS, REAL64, _eight_byte_real(dbu * 1e-6 / unit) + _eight_byte_real(dbu * 1e-6)))
+
+
+def library_footer():
+    return record(ENDLIB, NO_DATA)
+
+
+def structure_header(cellname):
+    return record(BGNSTR, INT16, b'\0' * 24) + ascii_record(STRNAME, cellname)
+
+
+def structure_footer():
+    return record(ENDSTR, NO_DATA)
+
+
+def boundary_records(layer, datatype, points):
+    ''' Vectorized BOUNDARY elements for many polygons that have the same number of vertices.
+        points is an integer array of shape (npolygons, nvertices, 2) in database units.
+        Returns bytes. Polygons are closed here, so do not repeat the first point.
+    '''
+    npoly, nvert, _ = points.shape
+    if nvert + 1 > max_boundary_points:
+        raise ValueError('Polygons with {} vertices do not fit in a GDSII XY record'.format(nvert))
+    closed = np.concatenate([points, points[:, :1]], axis=1).astype('>i4').reshape(npoly, -1)
+    prefix = (record(BOUNDARY, NO_DATA)
+              + record(LAYER, INT16, struct.pack('>H', layer))
+              + record(DATATYPE, INT16, struct.pack('>H', datatype))
+              + struct.pack('>HBB', 4 + 8 * (nvert + 1), XY, INT32))
+    suffix = record(ENDEL, NO_DATA)
+    rows = np.empty((npoly, len(prefix) + 8 * (nvert + 1) + len(suffix)), dtype=np.uint8)
+    rows[:, :len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+    rows[:, len(prefix):-len(suffix)] = closed.view(np.uint8)
+    rows[:, -len(suffix):] = np.frombuffer(suffix, dtype=np.uint8)
+    return rows.tobytes()
+
+
+context_info_cellname = '$$$CONTEXT_INFO$$$'  # klayout sometimes saves this extra top cell
+
+
+def is_gdsii(data):
+    ''' Whether these bytes (at least the first 4) start a GDSII stream '''
+    return bytes(data[:4]) == record(HEADER, INT16, b'\0\0')[:4]
+
+
+def database_unit(data):
+    ''' The database unit in microns from the UNITS record of a GDSII stream, or None '''
+    pos = 0
+    while pos + 4 <= len(data):
+        length = data[pos] << 8 | data[pos + 1]
+        rectype = data[pos + 2]
+        if rectype == UNITS:
+            return round(_from_eight_byte_real(data[pos + 12:pos + 20]) * 1e6, 12)
+        if rectype == BGNSTR or length < 4:
+            return None
+        pos += length
+    return None
+
+
+def _scan_buffer(buf, spans=None):
+    ''' Steps through the records of a GDSII buffer without decoding anything but the cell names.
+        Returns an OrderedDict of cell name -> list of the names it references, in file order.
+        If spans is a dict, it is filled with cell name -> (start, end) byte positions of that structure.
+    '''
+    def ascii_payload(pos, length):
+        return bytes(buf[pos + 4:pos + length]).rstrip(b'\0').decode('ascii')
+
+    graph = OrderedDict()
+    children = None
+    name = None
+    start = None
+    in_reference = False
+    interesting = frozenset([BGNSTR, STRNAME, SREF, AREF, SNAME, ENDSTR, ENDLIB])
+    pos = 0
+    end = len(buf)
+    while pos + 4 <= end:
+        length = buf[pos] << 8 | buf[pos + 1]
+        rectype = buf[pos + 2]
+        # Almost all records are geometry. Get past them with as little work as possible
+        if rectype in interesting:
+            if rectype == BGNSTR:
+                start = pos
+            elif rectype == STRNAME:
+                name = ascii_payload(pos, length)
+                children = graph.setdefault(name, [])
+            elif rectype == SREF or rectype == AREF:
+                in_reference = True
+            elif rectype == SNAME and in_reference:
+                children.append(ascii_payload(pos, length))
+                in_reference = False
+            elif rectype == ENDSTR:
+                if spans is not None:
+                    spans[name] = (start, pos + length)
+                children = None
+            elif rectype == ENDLIB:
+                break
+        if length < 4:
+            raise ValueError('Corrupt GDSII record at byte {}'.format(pos))
+        pos += length
+    return graph
+
+
+@contextlib.contextmanager
+def _source_buffer(source):
+    ''' source can be a filename, which is memory-mapped, or a binary stream or bytes '''
+    if isinstance(source, str):
+        with open(source, 'rb') as fx:
+            try:
+                buf = mmap.mmap(fx.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                yield b''
+                return
+            try:
+                yield buf
+            finally:
+                buf.close()
+    elif hasattr(source, 'getbuffer'):  # io.BytesIO: no copy
+        buf = source.getbuffer()
+        try:
+            yield buf
+        finally:
+            buf.release()
+    elif hasattr(source, 'read'):
+        position = source.tell()
+        data = source.read()
+        source.seek(position)
+        yield data
+    else:
+        yield source
+
+
+def cell_graph(source):
+    ''' Finds the cell hierarchy of a GDSII file without loading any geometry.
+        source can be a filename, which is memory-mapped, or a binary stream or bytes.
+        Returns an OrderedDict of cell name -> list of the cell names it references (repeats included).
+    '''
+    with _source_buffer(source) as buf:
+        return _scan_buffer(buf)
+
+
+def subtree(source, cellname):
+    ''' A GDSII stream (bytes) with only the named cell and the cells under it.
+        The other structures are skipped without being decoded.
+    '''
+    with _source_buffer(source) as buf:
+        spans = OrderedDict()
+        graph = _scan_buffer(buf, spans)
+        if cellname not in graph:
+            raise ValueError('There is no cell named {}'.format(cellname))
+        keep = {cellname}
+        stack = [cellname]
+        while stack:
+            for child in graph[stack.pop()]:
+                if child not in keep:
+                    keep.add(child)
+                    stack.append(child)
+        first_structure = min(start for start, _ in spans.values())
+        pieces = [bytes(buf[:first_structure])]
+        pieces.extend(bytes(buf[start:end]) for name, (start, end) in spans.items() if name in keep)
+        pieces.append(library_footer())
+        return b''.join(pieces)
+
+
+def top_cells(source, graph=None):
+    ''' Names of the cells that are not referenced by any other cell, in file order.
+        Includes klayout's $$$CONTEXT_INFO$$$ cell, if it is there.
+    '''
+    if graph is None:
+        graph = cell_graph(source)
+    referenced = set()
+    for children in graph.values():
+        referenced.update(children)
+    return [name for name in graph.keys() if name not in referenced]
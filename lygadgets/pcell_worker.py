@@ -0,0 +1,227 @@
+''' Runs PCell generating functions in a separate, long-lived python process,
+    so that a slow one does not freeze the KLayout GUI.
+
+    The worker is started on first use and then stays warm: the modules that it has imported stay imported.
+    Generating functions are sent by name (module and qualified name) along with their keyword arguments.
+    The worker calls the function and sends the device back as GDS bytes.
+    Only reading those bytes into the cell happens in KLayout.
+
+    Inside the KLayout application, sys.executable is KLayout itself, so the worker is started with system python
+    (see system_linker.system_python). Elsewhere, it is sys.executable.
+    The worker needs lygadgets and whatever the generating functions import, but not the klayout package.
+
+    Messages in both directions are pickles, each preceded by its length.
+    Anything that the generating functions print goes to the worker's stderr.
+'''
+import os
+import io
+import sys
+import time
+import queue
+import atexit
+import pickle
+import struct
+import threading
+import traceback
+import subprocess
+
+_header = struct.Struct('>Q')
+
+
+class WorkerError(RuntimeError):
+    ''' The generating function raised an exception in the worker, or the worker died '''
+    pass
+
+
+def _send(stream, obj):
+    data = pickle.dumps(obj, protocol=2)
+    stream.write(_header.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def _receive(stream):
+    ''' Returns None at the end of the stream '''
+    header = stream.read(_header.size)
+    if len(header) < _header.size:
+        return None
+    size, = _header.unpack(header)
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return pickle.loads(data)
+
+
+def worker_python():
+    ''' The python executable for the worker '''
+    from lygadgets.environment import isGSI
+    if isGSI():
+        from lygadgets.system_linker import system_python
+        return system_python()
+    return sys.executable
+
+
+def process_pool(processes=None):
+    ''' A concurrent.futures.ProcessPoolExecutor that also works inside KLayout.
+        There, its workers are fresh processes of worker_python(): forking KLayout would copy a multithreaded Qt application,
+        and spawning sys.executable would start another KLayout.
+        The functions and arguments sent to it must then be importable and picklable by system python.
+        Elsewhere, it is the default kind of pool.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from lygadgets.environment import isGSI
+    if not isGSI():
+        return ProcessPoolExecutor(processes)
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(worker_python())
+    return ProcessPoolExecutor(processes, mp_context=context)
+
+
+class PCellWorker(object):
+    ''' One worker process. It answers one request at a time, in order.
+        If it dies, or is killed after a timeout, it is started again on the next request.
+    '''
+    def __init__(self, python=None):
+        self.python = python
+        self._process = None
+        self._responses = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        python = self.python or worker_python()
+        env = os.environ.copy()
+        lygadgets_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([lygadgets_parent] + [p for p in [env.get('PYTHONPATH')] if p])
+        self._process = subprocess.Popen([python, '-m', 'lygadgets.pcell_worker'],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self._responses = queue.Queue()
+        reader = threading.Thread(target=self._read_responses, args=(self._process.stdout, self._responses))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _read_responses(stdout, responses):
+        while True:
+            try:
+                response = _receive(stdout)
+            except Exception:
+                response = None
+            responses.put(response)
+            if response is None:
+                return
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def stop(self, kill=False):
+        ''' Lets the worker finish, or with kill=True, does not wait for it '''
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        if not kill:
+            try:
+                process.wait(5)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        process.kill()
+        process.wait()
+
+    def generate(self, generating_function, kwargs, timeout=None, poll=None, poll_interval=0.1):
+        ''' Calls generating_function(**kwargs) in the worker and returns the device as GDS bytes.
+
+            While waiting, poll() is called every poll_interval seconds. If it raises, the worker is killed.
+            After timeout seconds, the worker is killed and TimeoutError is raised.
+            If the generating function raises, WorkerError is raised with its traceback.
+        '''
+        module = generating_function.__module__
+        qualname = getattr(generating_function, '__qualname__', generating_function.__name__)
+        if module == '__main__' or '<locals>' in qualname:
+            raise ValueError('{} must be importable by name to run out of process'.format(qualname))
+        request = dict(module=module, qualname=qualname, kwargs=kwargs, path=list(sys.path))
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+            try:
+                _send(self._process.stdin, request)
+            except OSError:  # it died since the last request
+                self.stop(kill=True)
+                self.start()
+                _send(self._process.stdin, request)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while True:
+                    wait = poll_interval if poll is not None else None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError('{} took more than {} s'.format(qualname, timeout))
+                        wait = remaining if wait is None else min(wait, remaining)
+                    try:
+                        response = self._responses.get(timeout=wait)
+                        break
+                    except queue.Empty:
+                        if poll is not None:
+                            poll()
+            except BaseException:
+                # It is still working on the request. The only way to stop it is to kill it
+                self.stop(kill=True)
+                raise
+        if response is None:
+            self.stop(kill=True)
+            raise WorkerError('The PCell worker process died while running {}'.format(qualname))
+        status, payload = response
+        if status == 'error':
+            raise WorkerError('{} raised in the PCell worker process:\n{}'.format(qualname, payload))
+        return payload
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    ''' The shared worker, created on first use. It is stopped when python exits '''
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = PCellWorker()
+            atexit.register(_worker.stop, True)
+        return _worker
+
+
+def serve(stdin, stdout):
+    ''' The worker's loop '''
+    from importlib import import_module
+    from lygadgets.cell_translation import any_write
+    while True:
+        request = _receive(stdin)
+        if request is None:
+            return
+        try:
+            for entry in request['path']:
+                if entry not in sys.path:
+                    sys.path.append(entry)
+            function = import_module(request['module'])
+            for name in request['qualname'].split('.'):
+                function = getattr(function, name)
+            device = function(**request['kwargs'])
+            buffer = io.BytesIO()
+            any_write(device, buffer, format='GDS2', write_ports=True)
+            response = ('ok', buffer.getvalue())
+        except Exception:
+            response = ('error', traceback.format_exc())
+        _send(stdout, response)
+
+
+if __name__ == '__main__':
+    # The messages get the real stdout. Anything printed goes to stderr
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    serve(sys.stdin.buffer, channel)
@@ -0,0 +1,158 @@
+''' Where the time goes when PCells are produced and cells are translated.
+
+    Each WrappedPCell.produce_impl is a record, named after its generating function.
+    anyCell_to_anyCell is a record of its own if it is called outside of a PCell.
+    Within a record, phases (generate, write, read, copy_tree, ...) are timed.
+    Phases can be nested. Their names are then paths, like "anyCell_to_anyCell/read/copy_tree".
+    Phase times include their nested phases.
+
+        from lygadgets import profiling
+        print(profiling.report())
+        profiling.start_trace()
+        ...  # use some PCells
+        profiling.dump_trace('pcells.json')  # open in chrome://tracing or https://ui.perfetto.dev
+
+    Counting is always on. It costs a few microseconds per record. Set enabled = False to turn it off.
+'''
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+enabled = True
+
+_lock = threading.Lock()
+_stats = dict()  # record name -> {'calls', 'seconds', 'polygons', 'phases': {phase path: seconds}}
+_local = threading.local()  # .stack: list of [record name, phase path list]
+_trace_events = None
+
+
+def _new_stats():
+    return dict(calls=0, seconds=0., polygons=0, phases=dict())
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def _trace(name, category, tstart, tstop, **args):
+    events = _trace_events
+    if events is not None:
+        events.append(dict(name=name, cat=category, ph='X', ts=tstart * 1e6, dur=(tstop - tstart) * 1e6,
+                           pid=os.getpid(), tid=threading.get_ident(), args=args))
+
+
+@contextmanager
+def record(name):
+    ''' Times a call of name, like one produce_impl.
+        If there is already a record going on in this thread, this is just a phase of that one.
+    '''
+    if not enabled:
+        yield
+        return
+    stack = _stack()
+    if stack:
+        with phase(name):
+            yield
+        return
+    stack.append([name, []])
+    tstart = time.perf_counter()
+    try:
+        yield
+    finally:
+        tstop = time.perf_counter()
+        stack.pop()
+        with _lock:
+            entry = _stats.setdefault(name, _new_stats())
+            entry['calls'] += 1
+            entry['seconds'] += tstop - tstart
+        _trace(name, 'record', tstart, tstop)
+
+
+@contextmanager
+def phase(name):
+    ''' Times one part of the current record. Outside of a record, it only shows up in the trace '''
+    if not enabled:
+        yield
+        return
+    stack = _stack()
+    if stack:
+        stack[-1][1].append(name)
+        path = '/'.join(stack[-1][1])
+    tstart = time.perf_counter()
+    try:
+        yield
+    finally:
+        tstop = time.perf_counter()
+        if stack:
+            stack[-1][1].pop()
+            with _lock:
+                phases = _stats.setdefault(stack[-1][0], _new_stats())['phases']
+                phases[path] = phases.get(path, 0.) + tstop - tstart
+        _trace(name, 'phase', tstart, tstop)
+
+
+def count_polygons(npolygons):
+    ''' Adds to the polygon count of the current record '''
+    stack = _stack()
+    if enabled and stack:
+        with _lock:
+            _stats.setdefault(stack[-1][0], _new_stats())['polygons'] += npolygons
+
+
+def stats(names=None):
+    ''' Copy of the statistics: record name -> dict of calls, seconds, polygons, and phases (path -> seconds).
+        names limits it to those records.
+    '''
+    with _lock:
+        return {name: dict(entry, phases=dict(entry['phases']))
+                for name, entry in _stats.items()
+                if names is None or name in names}
+
+
+def report(names=None):
+    ''' The statistics as a table, slowest first '''
+    ordered = sorted(stats(names).items(), key=lambda item: -item[1]['seconds'])
+    lines = ['{:32s} {:>7s} {:>10s} {:>10s} {:>10s}'.format('name', 'calls', 'total (s)', 'mean (ms)', 'polygons')]
+    for name, entry in ordered:
+        lines.append('{:32s} {:7d} {:10.4f} {:10.3f} {:10d}'.format(
+            name, entry['calls'], entry['seconds'], 1e3 * entry['seconds'] / max(entry['calls'], 1), entry['polygons']))
+        for path, seconds in sorted(entry['phases'].items()):
+            lines.append('    {:28s} {:7s} {:10.4f}'.format(path, '', seconds))
+    return '\n'.join(lines)
+
+
+def dump_stats(filename, names=None):
+    with open(filename, 'w') as fx:
+        json.dump(stats(names), fx, indent=1)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def start_trace():
+    ''' Starts keeping every record and phase as a Chrome trace event '''
+    global _trace_events
+    _trace_events = []
+
+
+def stop_trace():
+    ''' Stops tracing and gives the events '''
+    global _trace_events
+    events, _trace_events = _trace_events, None
+    return events or []
+
+
+def dump_trace(filename, stop=True):
+    ''' Writes the trace events to a JSON file in the Chrome trace event format '''
+    events = stop_trace() if stop else list(_trace_events or [])
+    with open(filename, 'w') as fx:
+        json.dump(OrderedDict([('traceEvents', events), ('displayTimeUnit', 'ms')]), fx)
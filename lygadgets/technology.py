@@ -10,30 +10,341 @@
     - Technology.technology_by_name, or
     - Technology.has_technology
 
+    By default (Technology.lazy = True), autoload only finds the names of the technologies.
+    A technology is parsed and registered when it is first asked for by technology_by_name.
+
+    Crawling salt for .lyt files can be slow, so what was found is kept in a TechnologyIndex in klayout_home/lygadgets_cache.
+    Later processes only recrawl directories that changed.
+    In a long-running process, Technology.refresh_salt picks up .lyt files that were added, edited, or removed.
+
     lygadgets.Technology also offers a new method: register_lyt
     which takes the .lyt file, turns it into a Technology object (eventually returns), and adds to the class registry
 '''
 from lygadgets import klayout_home, pya
 import xmltodict
 import os
+import json
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from xml.etree import ElementTree
 
 # default active is tricky and a bad idea if it just for CL convenience
 # perhaps lygadgets has an idea of active technology
 # this would have to be influenced by GUI switches, but those are not global
 
+def _mtime(path):
+    ''' Modification time in ns, or None if it does not exist '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def file_signature(path):
+    ''' (mtime in ns, size), or None if it does not exist '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DirectoryWatcher(object):
+    ''' Tells whether anything happened in some directories (not their subdirectories) since it was last asked.
+
+        It uses inotify, through ctypes, on Linux. Elsewhere, or if the system runs out of inotify watches,
+        changed() is always True, and it is up to the caller to look at mtimes.
+    '''
+    _mask = (0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800)  # modify, attrib, close_write, moves, create, delete
+    _gone = (0x400 | 0x800 | 0x8000)  # delete_self, move_self, ignored: the watch does not follow the path anymore
+    _event = struct.Struct('iIII')  # wd, mask, cookie, len, then len bytes of name
+    _IN_NONBLOCK = os.O_NONBLOCK
+    _IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        self._fd = None
+        self._watched = dict()  # (directory, st_dev, st_ino), or (directory, None, None) if it did not exist: watch descriptor
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        except (OSError, AttributeError):  # not Linux
+            return
+        if fd >= 0:
+            self._fd = fd
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def watch(self, directories):
+        ''' Adds directories. Returns the ones that were not watched before.
+            Anything that happened in those before this call is missed, so look at them again afterwards.
+            For one that does not exist, its parent is watched, to see when it is made.
+        '''
+        new = []
+        for directory in directories:
+            if self._fd is None:
+                break
+            # By inode, so that a directory deleted and made again at the same path is watched again
+            try:
+                stat = os.stat(directory)
+                key = (directory, stat.st_dev, stat.st_ino)
+                watched = directory
+            except OSError:
+                key = (directory, None, None)
+                watched = os.path.dirname(directory)
+            if key in self._watched:
+                continue
+            wd = self._add_watch(self._fd, os.fsencode(watched), self._mask)
+            if wd < 0 and os.path.isdir(watched):  # out of watches. Fall back to mtimes
+                self.close()
+                break
+            self._watched[key] = wd
+            new.append(directory)
+        return new
+
+    def changed(self):
+        if self._fd is None:
+            return True
+        happened = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            happened = True
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._event.unpack_from(data, offset)
+                offset += self._event.size + length
+                if mask & self._gone:
+                    # Deleted or moved. Forget it, so that _watched does not grow
+                    self._watched = {key: other for key, other in self._watched.items() if other != wd}
+        return happened
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+# Directories that the crawl for .lyt files does not go into. Matched against the directory name with fnmatch
+crawl_prune_patterns = ['.*', '__pycache__', 'node_modules', 'python', 'pymacros', 'macros', '*.egg-info', 'build', 'dist']
+# How many directories deep the crawl goes, below where it starts
+crawl_max_depth = 8
+
+
+def scan_for_lyt(path, prune_patterns=None, max_depth=None):
+    ''' Returns the .lyt files under path (sorted), and the directories that were looked at, with their mtimes.
+
+        Symbolic links are followed, but no directory is visited twice, so link cycles are harmless.
+        Directories matching prune_patterns (default: crawl_prune_patterns) are skipped.
+        If a directory has a tech/ subdirectory, like a salt grain, only that one is crawled further.
+    '''
+    if prune_patterns is None:
+        prune_patterns = crawl_prune_patterns
+    if max_depth is None:
+        max_depth = crawl_max_depth
+    lyt_files = []
+    directories = dict()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return lyt_files, {path: None}
+    visited = {(stat.st_dev, stat.st_ino)}
+    stack = [(path, stat.st_mtime_ns, 0)]
+    while stack:
+        directory, mtime, depth = stack.pop()
+        directories[directory] = mtime
+        subdirectories = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            subdirectories.append(entry)
+                        elif entry.name.endswith('.lyt') and entry.is_file():
+                            lyt_files.append(entry.path)
+                    except OSError:  # broken link
+                        continue
+        except OSError:
+            continue
+        if depth >= max_depth:
+            continue
+        grain_tech = [entry for entry in subdirectories if entry.name == 'tech']
+        for entry in grain_tech or subdirectories:
+            if any(fnmatch(entry.name, pattern) for pattern in prune_patterns):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            stack.append((entry.path, stat.st_mtime_ns, depth + 1))
+    return sorted(lyt_files), directories
+
+
+def lyt_technology_name(lyt_filename):
+    ''' The name of the technology in a .lyt file, without building the Technology '''
+    depth = 0
+    for event, element in ElementTree.iterparse(lyt_filename, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1 and element.tag == 'name':
+                return element.text or ''
+    return ''
+
+
+def map_files(function, filenames, threads=None):
+    ''' [function(filename) for filename in filenames], in a pool of threads, which helps when reading is slow (network drives).
+        threads=None uses the default pool size, threads=0 does them here, one by one. The order is kept.
+    '''
+    filenames = list(filenames)
+    if threads == 0 or len(filenames) < 2:
+        return [function(filename) for filename in filenames]
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(function, filenames))
+
+
+def default_index_file():
+    return os.path.join(klayout_home(), 'lygadgets_cache', 'technologies.json')
+
+
+class TechnologyIndex(object):
+    ''' On-disk record of the .lyt files found under some directories, so that they do not have to be crawled every time.
+
+        For each crawled directory (root), it keeps the mtimes of all the directories below it, and the .lyt files found.
+        Adding, removing, or linking a file changes the mtime of its directory. If none changed, the list of files is still right.
+        For each .lyt file, it keeps mtime, size, and technology name, to tell whether it changed.
+
+        If filename is None, nothing is read or written.
+    '''
+    version = 1
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.roots = dict()  # root: {'directories': {directory: mtime}, 'lyt_files': [filenames]}
+        self.files = dict()  # lyt filename: {'mtime', 'size', 'name'}
+        self.modified = False
+        self.load()
+
+    def load(self):
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, 'r') as fx:
+                contents = json.load(fx)
+        except (OSError, ValueError):  # not there yet, or broken. Start over
+            return
+        if contents.get('version') != self.version:
+            return
+        self.roots = contents['roots']
+        self.files = contents['files']
+
+    def save(self):
+        ''' Writes it, if anything changed. Another process may be reading it, so it is written then renamed '''
+        if self.filename is None or not self.modified:
+            return
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(prefix='.technologies', suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w') as fx:
+                json.dump(dict(version=self.version, roots=self.roots, files=self.files), fx, indent=1)
+            os.replace(temporary, self.filename)
+        except OSError:  # read-only home. The next start will crawl again
+            return
+        self.modified = False
+
+    def root_is_current(self, root):
+        record = self.roots.get(root)
+        if record is None:
+            return False
+        return all(_mtime(directory) == mtime for directory, mtime in record['directories'].items())
+
+    def lyt_files(self, root, crawl=scan_for_lyt):
+        ''' The .lyt files under root. If any directory changed, crawl(root) finds them again '''
+        if not self.root_is_current(root):
+            lyt_files, directories = crawl(root)
+            self.roots[root] = dict(directories=directories, lyt_files=sorted(lyt_files))
+            self.modified = True
+        return list(self.roots[root]['lyt_files'])
+
+    def is_current(self, lyt_filename):
+        ''' True if lyt_filename has the same mtime and size as when it was recorded '''
+        entry = self.files.get(lyt_filename)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(lyt_filename)
+        except OSError:
+            return False
+        return entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def record(self, lyt_filename, tech_name):
+        try:
+            stat = os.stat(lyt_filename)
+        except OSError:
+            return
+        self.files[lyt_filename] = dict(mtime=stat.st_mtime_ns, size=stat.st_size, name=tech_name)
+        self.modified = True
+
+    def forget_missing(self):
+        ''' Drops records of files that are not under any root anymore '''
+        listed = set()
+        for record in self.roots.values():
+            listed.update(record['lyt_files'])
+        for lyt_filename in list(self.files.keys()):
+            if lyt_filename not in listed:
+                del self.files[lyt_filename]
+                self.modified = True
+
+
 if not pya:
     print('Did not find pya. You will not be able to use lygadgets.Technology')
     class Technology(object):
         pass
 else:
     class Technology(pya.Technology):
-        ''' '''
+        ''' Set use_index = False to crawl the salt directories every time, instead of using TechnologyIndex.
+            Set lazy = False to register all the technologies in salt as soon as any is asked for.
+            .lyt files are read by parse_threads threads (None: default pool size, 0: no threads),
+            but parsed and registered one by one, in order.
+            refresh_salt picks up changes in salt. Set auto_refresh = True to do that every time a technology is asked for.
+            With watch_salt, the first refresh_salt starts watching salt with inotify, which makes the later ones cheap.
+            Processes that never refresh do not pay for the watches.
+        '''
         _salt_loaded = False
+        _salt_lock = threading.RLock()
+        _unregistered = dict()  # tech name: lyt filename. Found in salt, but not parsed yet
+        _salt_files = dict()  # lyt filename: (file_signature, tech name). Everything found in salt
+        _watcher = None
+        use_index = True
+        lazy = True
+        parse_threads = None
+        watch_salt = True
+        auto_refresh = False
 
         @classmethod
         def _register_pyatech(cls, pya_tech):
-            if cls.has_technology(pya_tech.name):
-                new_tech = cls.technology_by_name(pya_tech.name)
+            cls._load_salt()  # first, so that salt does not take the name back later
+            cls._unregistered.pop(pya_tech.name, None)
+            if super().has_technology(pya_tech.name):
+                new_tech = super().technology_by_name(pya_tech.name)
             else:
                 new_tech = cls.create_technology(pya_tech.name)
 
@@ -44,31 +355,178 @@ else:
         @classmethod
         def register_lyt(cls, lyt_filename):
             pya_tech = _load_pya_tech(lyt_filename)
-            cls._register_pyatech(pya_tech)
+            with cls._salt_lock:
+                cls._register_pyatech(pya_tech)
             return pya_tech
 
         @classmethod
-        def crawl_for_technologies(cls, path):
-            for root, dirnames, filenames in os.walk(path, followlinks=True):
-                for fn in filenames:
-                    if fn.endswith('.lyt'):
-                        cls.register_lyt(os.path.join(root, fn))
+        def register_lyts(cls, lyt_filenames):
+            ''' register_lyt for each file. They are read in parallel (see parse_threads),
+                then parsed and registered in the order given, so if names repeat, the last one wins.
+                Parsing holds the GIL, so it is not worth doing in threads.
+            '''
+            contents = map_files(_read_lyt, lyt_filenames, cls.parse_threads)
+            pya_techs = [_parse_lyt(absolute_filepath, lyt_xml) for absolute_filepath, lyt_xml in contents]
+            with cls._salt_lock:
+                for pya_tech in pya_techs:
+                    cls._register_pyatech(pya_tech)
+            return pya_techs
+
+        @classmethod
+        def crawl_for_technologies(cls, path, index=None):
+            ''' Registers all the .lyt files under path.
+                With a TechnologyIndex, the crawl is skipped if no directory changed, and the index is updated.
+            '''
+            lyt_files = scan_for_lyt(path)[0] if index is None else index.lyt_files(path)
+            cls._add_lyt_files(lyt_files, index, lazy=False)
+
+        @classmethod
+        def index_technologies(cls, path, index=None):
+            ''' Like crawl_for_technologies, but only finds the names. Registration waits for technology_by_name.
+                Names come from the index, if the file did not change, or from a quick look at the file.
+            '''
+            lyt_files = scan_for_lyt(path)[0] if index is None else index.lyt_files(path)
+            cls._add_lyt_files(lyt_files, index, lazy=True)
+
+        @classmethod
+        def _add_lyt_files(cls, lyt_files, index=None, lazy=None):
+            ''' Registers lyt_files, or if lazy, only notes their names. Remembers them for refresh_salt '''
+            if lazy is None:
+                lazy = cls.lazy
+            if index is None:
+                stale = set(lyt_files)
+            else:
+                stale = set(lyt_filename for lyt_filename in lyt_files if not index.is_current(lyt_filename))
+            if lazy:
+                to_read = [lyt_filename for lyt_filename in lyt_files if lyt_filename in stale]
+                names = dict(zip(to_read, map_files(lyt_technology_name, to_read, cls.parse_threads)))
+            else:
+                names = {lyt_filename: pya_tech.name for lyt_filename, pya_tech in zip(lyt_files, cls.register_lyts(lyt_files))}
+            for lyt_filename in lyt_files:
+                if lyt_filename in stale:
+                    tech_name = names[lyt_filename]
+                    if index is not None:
+                        index.record(lyt_filename, tech_name)
+                else:
+                    tech_name = index.files[lyt_filename]['name']
+                if lazy:
+                    cls._unregistered[tech_name] = lyt_filename  # if names repeat, the last one wins, like in crawl_for_technologies
+                cls._salt_files[lyt_filename] = (file_signature(lyt_filename), tech_name)
+
+        @classmethod
+        def _forget_lyt(cls, lyt_filename):
+            ''' Undoes _add_lyt_files for one file. If another file has the same technology name, that one takes over '''
+            tech_name = cls._salt_files.pop(lyt_filename)[1]
+            if cls._unregistered.get(tech_name) == lyt_filename:
+                del cls._unregistered[tech_name]
+            others = [other for other, (_, name) in cls._salt_files.items() if name == tech_name]
+            if others:
+                cls._add_lyt_files(others[-1:])
+            elif super().has_technology(tech_name):
+                cls.remove_technology(tech_name)
+
+        @classmethod
+        def _salt_paths(cls):
+            return [os.path.join(klayout_home(), 'salt'), os.path.join(klayout_home(), 'tech')]
+
+        @classmethod
+        def _find_salt_lyt(cls, index):
+            ''' The .lyt files in salt, and the directories that were looked at '''
+            lyt_files = []
+            directories = dict()
+            for path in cls._salt_paths():
+                if index is None:
+                    found, looked_at = scan_for_lyt(path)
+                else:
+                    found = index.lyt_files(path)
+                    looked_at = index.roots[path]['directories']
+                lyt_files.extend(found)
+                directories.update(looked_at)
+            return lyt_files, directories
 
         @classmethod
         def _load_salt(cls):
             ''' Crawls through klayout_home directory looking for .lyt files.
-                Registers them with the class, returns nothing
+                Registers them with the class, returns nothing.
+                If several threads ask at once, one crawls, and the others wait for it.
             '''
-            if cls._salt_loaded:
-                return None
-            cls._salt_loaded = True
-            if os.path.isdir(klayout_home()):
-                cls.crawl_for_technologies(os.path.join(klayout_home(), 'salt'))
-                cls.crawl_for_technologies(os.path.join(klayout_home(), 'tech'))
+            with cls._salt_lock:
+                if cls._salt_loaded:
+                    return None
+                cls._salt_loaded = True  # registering comes back here
+                cls._unregistered = dict()
+                cls._salt_files = dict()
+                if cls._watcher is not None:
+                    cls._watcher.close()
+                    cls._watcher = None
+                if os.path.isdir(klayout_home()):
+                    index = TechnologyIndex(default_index_file()) if cls.use_index else None
+                    lyt_files, _ = cls._find_salt_lyt(index)
+                    cls._add_lyt_files(lyt_files, index)
+                    if index is not None:
+                        index.forget_missing()
+                        index.save()
+
+        @classmethod
+        def _materialize(cls, tech_name):
+            ''' Registers tech_name, if it was found in salt but not registered yet '''
+            with cls._salt_lock:
+                lyt_filename = cls._unregistered.pop(tech_name, None)
+                if lyt_filename is not None:
+                    cls.register_lyt(lyt_filename)
 
         @classmethod
         def reload_salt(cls):
-            cls._salt_loaded = False
+            ''' The next time a technology is asked for, salt is crawled again, and everything is registered again.
+                refresh_salt is usually faster
+            '''
+            with cls._salt_lock:
+                cls._salt_loaded = False
+
+        @classmethod
+        def refresh_salt(cls):
+            ''' Incremental reload_salt. Finds the .lyt files that were added, changed, or removed since salt was loaded,
+                and only registers, registers again, or removes those technologies.
+                Returns the lists of (added, changed, removed) filenames.
+
+                The mtimes of the salt directories and .lyt files are checked.
+                With watch_salt, where inotify works (Linux), the first call also starts watching the salt directories.
+                After that, nothing on disk is looked at unless something happened in one of them.
+            '''
+            with cls._salt_lock:
+                if not cls._salt_loaded:
+                    cls._load_salt()
+                    return list(cls._salt_files.keys()), [], []
+                if cls._watcher is not None and not cls._watcher.changed():
+                    return [], [], []
+                if cls._watcher is None and cls.watch_salt:
+                    cls._watcher = DirectoryWatcher()
+                index = TechnologyIndex(default_index_file()) if cls.use_index else None
+                while True:
+                    lyt_files, directories = cls._find_salt_lyt(index)
+                    if cls._watcher is None or not cls._watcher.uses_inotify:
+                        break
+                    if not cls._watcher.watch(directories):
+                        break
+                    # Something could have happened in the new ones between the crawl and the watch. Look again
+                found = set(lyt_files)
+                removed = [lyt_filename for lyt_filename in cls._salt_files if lyt_filename not in found]
+                added = [lyt_filename for lyt_filename in lyt_files if lyt_filename not in cls._salt_files]
+                changed = [lyt_filename for lyt_filename in lyt_files
+                           if lyt_filename in cls._salt_files and file_signature(lyt_filename) != cls._salt_files[lyt_filename][0]]
+                for lyt_filename in removed + changed:
+                    cls._forget_lyt(lyt_filename)
+                cls._add_lyt_files([lyt_filename for lyt_filename in lyt_files if lyt_filename in set(added + changed)], index)
+                if index is not None:
+                    index.forget_missing()
+                    index.save()
+                return added, changed, removed
+
+        @classmethod
+        def _update_salt(cls):
+            cls._load_salt()
+            if cls.auto_refresh:
+                cls.refresh_salt()
 
 
         # These override methods of pya.Technology
@@ -76,20 +534,22 @@ else:
         @classmethod
         def technology_names(cls):
             ''' Equivalent behavior to pya.Technology.technology_names() in klayout's GSI '''
-            cls._load_salt()
-            return super().technology_names()
+            cls._update_salt()
+            names = super().technology_names()
+            return names + [name for name in cls._unregistered if name not in names]
 
         @classmethod
         def technology_by_name(cls, tech_name):
             ''' Equivalent behavior to pya.Technology.technology_by_name() in klayout's GSI '''
-            cls._load_salt()
+            cls._update_salt()
+            cls._materialize(tech_name)
             return super().technology_by_name(tech_name)
 
         @classmethod
         def has_technology(cls, tech_name):
             ''' Equivalent behavior to pya.Technology.has_technology() in klayout's GSI '''
-            cls._load_salt()
-            return super().has_technology(tech_name)
+            cls._update_salt()
+            return tech_name in cls._unregistered or super().has_technology(tech_name)
 
         # End of overrides.
 
@@ -98,10 +558,18 @@ else:
         ''' Parses the .lyt which is in xml format.
             Returns the new Technology object. Does not register it to the Technology class
         '''
+        return _parse_lyt(*_read_lyt(lyt_filename))
+
+    def _read_lyt(lyt_filename):
+        ''' The first half of _load_pya_tech. This is the part that can go in threads '''
         # workaround while https://github.com/klayoutmatthias/klayout/pull/215 is not solved
         absolute_filepath = os.path.realpath(os.path.expanduser(lyt_filename))
         with open(absolute_filepath, 'r') as file:
             lyt_xml = file.read()
+        return absolute_filepath, lyt_xml
+
+    def _parse_lyt(absolute_filepath, lyt_xml):
+        ''' The second half of _load_pya_tech '''
         pya_tech = Technology.technology_from_xml(lyt_xml)
         pya_tech.default_base_path = os.path.dirname(absolute_filepath)
         # end of workaround
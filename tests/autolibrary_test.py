@@ -0,0 +1,174 @@
+import os, sys, json, time
+import pytest
+from lygadgets import pya, WrappedPCell, anyCell_to_anyCell
+from lygadgets.autolibrary import LazyWrappedPCell, pcell_cache, use_persistent_cache, function_fingerprint, pregenerate_pcells
+from lygadgets.caching import DiskCache
+from lygadgets import profiling
+from lygadgets.pcell_worker import get_worker, WorkerError
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),
+                                              '..', 'examples', 'salt', 'lypy_hybrid',
+                                              'tech', 'example_tech')))
+from lygadgets_pcells.pcell_examples import some_device
+
+
+def place_pcell(dbu=None, **params):
+    pya_layout = pya.Layout()
+    if dbu is not None:
+        pya_layout.dbu = dbu
+    pya_layout.register_pcell('some_device', WrappedPCell(some_device))
+    return pya_layout, pya_layout.create_cell('some_device', params)
+
+
+def test_pcell_cache():
+    pcell_cache.clear()
+    layout1, cell1 = place_pcell(width=10, height=20)
+    assert pcell_cache.info().misses == 1
+    layout2, cell2 = place_pcell(width=10, height=20)
+    assert pcell_cache.info().hits == 1
+    assert cell2.dbbox() == cell1.dbbox()
+    assert layout2.cells() == layout1.cells()
+
+    layout3, cell3 = place_pcell(width=11, height=20)
+    assert pcell_cache.info().misses == 2
+    assert cell3.dbbox().width() == cell1.dbbox().width() + 1
+
+
+def test_pcell_cache_dbu():
+    pcell_cache.clear()
+    layout1, coarse = place_pcell(dbu=0.01, width=1.234, height=20)
+    layout2, miss = place_pcell(dbu=0.001, width=1.234, height=20)
+    layout3, hit = place_pcell(dbu=0.001, width=1.234, height=20)
+    assert pcell_cache.info().misses == 2
+    assert pcell_cache.info().hits == 1
+    assert abs(coarse.dbbox().width() - 31.23) < 1e-9
+    assert abs(miss.dbbox().width() - 31.234) < 1e-9
+    assert hit.dbbox() == miss.dbbox()  # not the copy that was snapped to 0.01
+
+
+def test_persistent_cache(tmp_path):
+    disk_cache = use_persistent_cache(str(tmp_path))
+    try:
+        pcell_cache.clear()
+        layout1, cell1 = place_pcell(width=10, height=20)
+        assert disk_cache.info().misses == 1
+        assert len(disk_cache) == 1
+
+        pcell_cache.clear()  # like a new session
+        layout2, cell2 = place_pcell(width=10, height=20)
+        assert disk_cache.info().hits == 1
+        assert cell2.dbbox() == cell1.dbbox()
+        assert layout2.cells() == layout1.cells()
+    finally:
+        use_persistent_cache(False)
+
+
+def test_function_fingerprint():
+    def f(width=1):
+        return width
+    def g(width=1):
+        return width + 1
+    assert function_fingerprint(f) == function_fingerprint(f)
+    assert function_fingerprint(f) != function_fingerprint(g)
+
+
+def test_disk_cache_eviction(tmp_path):
+    def write_100_bytes(filename):
+        with open(filename, 'wb') as fx:
+            fx.write(b'x' * 100)
+    disk_cache = DiskCache(str(tmp_path), maxbytes=250)
+    for key in ['a', 'b', 'c']:
+        disk_cache.insert(key, write_100_bytes)
+        os.utime(disk_cache.path(key), (0, ord(key)))  # make the order unambiguous
+    assert 'a' not in disk_cache
+    assert disk_cache.lookup('c') is not None
+    assert disk_cache.info().currsize == 200
+
+
+def test_pregenerate():
+    pcell_cache.clear()
+    pcells = dict(some_device=WrappedPCell(some_device))
+    grid = dict(some_device=dict(width=[10, 11, 12], height=[20, 30]))
+    assert pregenerate_pcells(pcells, grid, processes=2) == 6
+    assert pregenerate_pcells(pcells, [('some_device', dict(width=10))], processes=1) == 0  # already there
+    assert pcell_cache.info().currsize == 6
+    maxsize = pcell_cache.maxsize
+    try:
+        pcell_cache.maxsize = 7
+        with pytest.raises(ValueError):
+            pregenerate_pcells(pcells, dict(some_device=dict(width=[13, 14])), processes=1)
+        assert pcell_cache.maxsize == 7
+        assert pregenerate_pcells(pcells, dict(some_device=dict(width=[13])), processes=1) == 1
+    finally:
+        pcell_cache.maxsize = maxsize
+    assert pcell_cache.info().currsize == 7
+
+    layout1, cell1 = place_pcell(width=11, height=30)
+    assert pcell_cache.info().hits == 1
+    assert pcell_cache.info().misses == 0
+    fresh_layout = pya.Layout()
+    fresh = anyCell_to_anyCell(some_device(width=11, height=30), fresh_layout.create_cell('fresh'))
+    assert cell1.dbbox() == fresh.dbbox()
+
+
+def test_lazy_pcell():
+    pcell_cache.clear()
+    declaration = LazyWrappedPCell(some_device)
+    pya_layout = pya.Layout()
+    pya_layout.register_pcell('some_device', declaration)
+    assert declaration._wrapped is None
+    cell = pya_layout.create_cell('some_device', dict(width=10, height=20))
+    assert declaration._wrapped is not None
+    layout1, cell1 = place_pcell(width=10, height=20)
+    assert cell.dbbox() == cell1.dbbox()
+
+
+def test_profiling(tmp_path):
+    pcell_cache.clear()
+    profiling.reset()
+    profiling.start_trace()
+    layout1, cell1 = place_pcell(width=10, height=20)
+    layout2, cell2 = place_pcell(width=10, height=20)
+    stats = profiling.stats()['some_device']
+    assert stats['calls'] == 2
+    assert stats['polygons'] > 0
+    assert stats['polygons'] % 2 == 0  # produced, then copied from the cache
+    for phase in ['cache', 'generate', 'translate', 'translate/anyCell_to_anyCell']:
+        assert phase in stats['phases']
+    assert 'some_device' in profiling.report()
+
+    trace_file = str(tmp_path / 'trace.json')
+    profiling.dump_trace(trace_file)
+    with open(trace_file) as fx:
+        events = json.load(fx)['traceEvents']
+    assert [e['name'] for e in events if e['cat'] == 'record'] == ['some_device', 'some_device']
+
+
+def slow_device(seconds=10.):
+    time.sleep(seconds)
+    return some_device()
+
+
+def broken_device(width=1.):
+    raise ValueError('no geometry today')
+
+
+def test_out_of_process():
+    pcell_cache.clear()
+    pya_layout = pya.Layout()
+    pya_layout.register_pcell('some_device', WrappedPCell(some_device, out_of_process=True))
+    cell = pya_layout.create_cell('some_device', dict(width=11, height=30))
+    fresh_layout = pya.Layout()
+    fresh = anyCell_to_anyCell(some_device(width=11, height=30), fresh_layout.create_cell('fresh'))
+    assert cell.dbbox() == fresh.dbbox()
+
+    pya_layout.register_pcell('slow_device', WrappedPCell(slow_device, out_of_process=True, timeout=0.5))
+    tstart = time.monotonic()
+    slow = pya_layout.create_cell('slow_device', dict(seconds=10.))
+    assert time.monotonic() - tstart < 5
+    texts = [shape.text_string for shape in slow.each_shape(pya_layout.layer(255, 0)) if shape.is_text()]
+    assert texts and texts[0].startswith('slow_device')
+    assert len(pcell_cache) == 1  # the placeholder is not cached
+
+    with pytest.raises(WorkerError, match='no geometry today'):
+        get_worker().generate(broken_device, dict(width=2.))
@@ -0,0 +1,69 @@
+import os
+import io
+import numpy as np
+from lygadgets import pya, gdsii
+from phidl import Device, geometry as pg
+
+
+def test_cell_graph():
+    unit = pg.rectangle((1, 2), layer=1)
+    mid = Device('mid')
+    mid << unit
+    mid.add_array(unit, columns=2, rows=2, spacing=(3, 3))
+    D = Device('top')
+    D << mid
+    D << pg.circle(layer=2)
+
+    buffer = io.BytesIO()
+    D.write_gds(buffer, cellname='top')
+    graph = gdsii.cell_graph(buffer)
+    assert set(graph.keys()) == {'top', 'mid', 'rectangle', 'circle'}
+    assert sorted(graph['mid']) == ['rectangle', 'rectangle']
+    assert gdsii.top_cells(buffer) == ['top']
+
+    # memory-mapped file from klayout
+    fn = 'test_scan.gds'
+    pya_layout = pya.Layout()
+    pya_layout.read_bytes(buffer.getvalue(), pya.LoadLayoutOptions())
+    pya_layout.create_cell('another_top')
+    pya_layout.write(fn)
+    try:
+        assert sorted(gdsii.top_cells(fn)) == ['another_top', 'top']
+    finally:
+        os.remove(fn)
+
+
+def test_boundary_records():
+    points = np.array([[[0, 0], [1000, 0], [1000, 2000]],
+                       [[0, 0], [-1000, 0], [-1000, -2000]]])
+    stream = b''.join([gdsii.library_header(0.001), gdsii.structure_header('tri'),
+                       gdsii.boundary_records(3, 4, points),
+                       gdsii.structure_footer(), gdsii.library_footer()])
+    pya_layout = pya.Layout()
+    pya_layout.read_bytes(stream, pya.LoadLayoutOptions())
+    assert pya_layout.dbu == 0.001
+    cell = pya_layout.cell('tri')
+    region = pya.Region(cell.shapes(pya_layout.find_layer(3, 4)))
+    assert region.count() == 2
+    assert region.area() == 2 * 1000 * 2000 / 2
+
+
+def test_subtree():
+    src = pya.Layout()
+    src.dbu = 0.005
+    leaf = src.create_cell('leaf')
+    leaf.shapes(src.layer(1, 0)).insert(pya.Box(0, 0, 100, 100))
+    block = src.create_cell('block')
+    block.insert(pya.CellInstArray(leaf.cell_index(), pya.Trans()))
+    chip = src.create_cell('chip')
+    chip.insert(pya.CellInstArray(block.cell_index(), pya.Trans()))
+    chip.insert(pya.CellInstArray(src.create_cell('other').cell_index(), pya.Trans()))
+    stream = src.write_bytes(pya.SaveLayoutOptions())
+
+    assert gdsii.is_gdsii(stream)
+    assert gdsii.database_unit(stream) == 0.005
+    data = gdsii.subtree(stream, 'block')
+    assert sorted(gdsii.cell_graph(data).keys()) == ['block', 'leaf']
+    pya_layout = pya.Layout()
+    pya_layout.read_bytes(data, pya.LoadLayoutOptions())
+    assert pya_layout.cell('block').dbbox() == block.dbbox()
@@ -0,0 +1,42 @@
+''' Startup time of WrappedLibrary, eager vs lazy PCell registration. Not collected by pytest. Run it directly:
+
+        python pcell_benchmark.py [number of functions]
+'''
+import sys
+import time
+import lygadgets
+from lygadgets import WrappedLibrary
+
+lygadgets.patch_environment()  # WrappedLibrary asks pya.Application for the version
+
+
+def make_functions(nfunctions, nparams=8):
+    ''' Generating functions with different names and signatures, like a big PDK '''
+    functions = []
+    for ifunc in range(nfunctions):
+        params = ', '.join('p{}={}'.format(iparam, float(iparam + ifunc)) for iparam in range(nparams))
+        namespace = dict()
+        exec('def device_{}({}):\n    pass'.format(ifunc, params), namespace)
+        functions.append(namespace['device_{}'.format(ifunc)])
+    return functions
+
+
+def startup_time(functions, lazy, repeats=3):
+    class BigLibrary(WrappedLibrary):
+        tech_name = 'benchmark_lazy' if lazy else 'benchmark_eager'
+        all_funcs_to_wrap = functions
+    BigLibrary.lazy = lazy
+    best = float('inf')
+    for _ in range(repeats):
+        tstart = time.perf_counter()
+        BigLibrary()
+        best = min(best, time.perf_counter() - tstart)
+    return best
+
+
+if __name__ == '__main__':
+    nfunctions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    functions = make_functions(nfunctions)
+    eager = startup_time(functions, lazy=False)
+    lazy = startup_time(functions, lazy=True)
+    print('{} functions: eager {:.4f} s, lazy {:.4f} s ({:.1f}x)'.format(nfunctions, eager, lazy, eager / lazy))
@@ -0,0 +1,208 @@
+import os
+import shutil
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from lygadgets import technology
+from lygadgets.technology import Technology, TechnologyIndex, DirectoryWatcher, scan_for_lyt, lyt_technology_name
+
+example_lyt = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'examples', 'salt', 'lypy_hybrid',
+                                            'tech', 'example_tech', 'example_tech.lyt'))
+
+
+def make_salt(salt_dir, names):
+    ''' One grain per name, each with a tech/<name>/<name>.lyt '''
+    for name in names:
+        tech_dir = os.path.join(str(salt_dir), name, 'tech', name)
+        os.makedirs(tech_dir)
+        with open(example_lyt) as fx:
+            xml = fx.read().replace('<name>example_tech</name>', '<name>{}</name>'.format(name), 1)
+        with open(os.path.join(tech_dir, name + '.lyt'), 'w') as fx:
+            fx.write(xml)
+
+
+def test_technology_index(tmp_path):
+    salt = tmp_path / 'salt'
+    make_salt(salt, ['a', 'b'])
+    index_file = str(tmp_path / 'technologies.json')
+    crawled = []
+
+    def crawl(root):
+        crawled.append(root)
+        return scan_for_lyt(root)
+
+    index = TechnologyIndex(index_file)
+    lyt_files = index.lyt_files(str(salt), crawl)
+    assert [os.path.basename(fn) for fn in lyt_files] == ['a.lyt', 'b.lyt']
+    for fn in lyt_files:
+        index.record(fn, os.path.basename(fn)[:-4])
+    index.save()
+
+    index = TechnologyIndex(index_file)  # like a new process
+    assert index.lyt_files(str(salt), crawl) == lyt_files
+    assert len(crawled) == 1
+    assert all(index.is_current(fn) for fn in lyt_files)
+
+    with open(lyt_files[0], 'a') as fx:
+        fx.write('\n')
+    assert not index.is_current(lyt_files[0])
+
+    make_salt(salt, ['c'])
+    assert len(index.lyt_files(str(salt), crawl)) == 3
+    assert len(crawled) == 2
+
+
+def registered_names():
+    return super(Technology, Technology).technology_names()
+
+
+def test_lazy_technologies(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLAYOUT_HOME', str(tmp_path))
+    make_salt(tmp_path / 'salt', ['lazy_a', 'lazy_b'])
+    assert lyt_technology_name(str(tmp_path / 'salt' / 'lazy_a' / 'tech' / 'lazy_a' / 'lazy_a.lyt')) == 'lazy_a'
+    Technology.reload_salt()
+    try:
+        assert {'lazy_a', 'lazy_b'} <= set(Technology.technology_names())
+        assert Technology.has_technology('lazy_b')
+        assert 'lazy_a' not in registered_names()
+        assert Technology.technology_by_name('lazy_a').name == 'lazy_a'
+        assert 'lazy_a' in registered_names()
+        assert 'lazy_b' not in registered_names()
+    finally:
+        Technology.reload_salt()
+
+
+def test_scan_for_lyt(tmp_path):
+    salt = tmp_path / 'salt'
+    make_salt(salt, ['a'])
+    grain = salt / 'a'
+    os.makedirs(str(grain / '.git'))
+    (grain / '.git' / 'stray.lyt').write_text('')
+    (grain / 'docs').mkdir()
+    (grain / 'docs' / 'outside_of_tech.lyt').write_text('')
+    os.symlink(str(salt), str(grain / 'tech' / 'loop'))  # a cycle
+    lyt_files, directories = scan_for_lyt(str(salt))
+    assert lyt_files == [str(grain / 'tech' / 'a' / 'a.lyt')]
+    assert str(grain / '.git') not in directories
+
+    deep = salt / 'b' / 'c' / 'd' / 'e'
+    os.makedirs(str(deep))
+    (deep / 'deep.lyt').write_text('')
+    assert len(scan_for_lyt(str(salt), max_depth=3)[0]) == 1
+    assert len(scan_for_lyt(str(salt), max_depth=4)[0]) == 2
+
+
+def test_parallel_technologies(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLAYOUT_HOME', str(tmp_path))
+    names = ['parallel_{}'.format(i) for i in range(20)]
+    make_salt(tmp_path / 'salt', names)
+    crawled = []
+
+    def counted_scan(path, *args, **kwargs):
+        crawled.append(path)
+        return scan_for_lyt(path, *args, **kwargs)
+    monkeypatch.setattr(technology, 'scan_for_lyt', counted_scan)
+    monkeypatch.setattr(Technology, 'lazy', False)
+    monkeypatch.setattr(Technology, 'use_index', False)
+    monkeypatch.setattr(Technology, 'parse_threads', 4)
+    Technology.reload_salt()
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            all_names = list(pool.map(lambda _: Technology.technology_names(), range(4)))
+        assert len(crawled) == 2  # salt and tech, once
+        for found in all_names:
+            assert set(names) <= set(found)
+        assert set(names) <= set(registered_names())
+        tech = Technology.technology_by_name('parallel_7')
+        assert tech.default_base_path.endswith(os.path.join('parallel_7', 'tech', 'parallel_7'))
+    finally:
+        Technology.reload_salt()
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+@pytest.mark.parametrize('watch_salt', [True, False])
+def test_refresh_salt(tmp_path, monkeypatch, lazy, watch_salt):
+    monkeypatch.setenv('KLAYOUT_HOME', str(tmp_path))
+    monkeypatch.setattr(Technology, 'lazy', lazy)
+    monkeypatch.setattr(Technology, 'watch_salt', watch_salt)
+    salt = tmp_path / 'salt'
+    make_salt(salt, ['refresh_a', 'refresh_b'])
+    Technology.reload_salt()
+    try:
+        assert Technology.technology_by_name('refresh_a').name == 'refresh_a'
+        assert Technology._watcher is None  # not until the first refresh
+        assert Technology.refresh_salt() == ([], [], [])
+        assert (Technology._watcher is not None) == watch_salt
+
+        make_salt(salt, ['refresh_c'])
+        lyt_a = str(salt / 'refresh_a' / 'tech' / 'refresh_a' / 'refresh_a.lyt')
+        with open(lyt_a) as fx:
+            xml = fx.read()
+        with open(lyt_a, 'w') as fx:
+            fx.write(xml.replace('<name>refresh_a</name>', '<name>refresh_renamed</name>'))
+        os.remove(str(salt / 'refresh_b' / 'tech' / 'refresh_b' / 'refresh_b.lyt'))
+
+        added, changed, removed = Technology.refresh_salt()
+        assert [os.path.basename(fn) for fn in added] == ['refresh_c.lyt']
+        assert changed == [lyt_a]
+        assert [os.path.basename(fn) for fn in removed] == ['refresh_b.lyt']
+        names = Technology.technology_names()
+        assert 'refresh_c' in names and 'refresh_renamed' in names
+        assert 'refresh_a' not in names and 'refresh_b' not in names
+        assert Technology.refresh_salt() == ([], [], [])
+    finally:
+        Technology.reload_salt()
+
+
+@pytest.mark.skipif(not DirectoryWatcher().uses_inotify, reason='needs inotify')
+def test_refresh_salt_new_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLAYOUT_HOME', str(tmp_path))
+    salt = tmp_path / 'salt'
+    make_salt(salt, ['refresh_a'])
+    Technology.reload_salt()
+    try:
+        Technology.refresh_salt()
+        Technology.refresh_salt()  # now it is watching
+
+        make_salt(salt, ['refresh_b'])
+        find_salt_lyt = Technology._find_salt_lyt
+        late_lyt = salt / 'refresh_b' / 'tech' / 'refresh_b' / 'late.lyt'
+
+        def find_then_write(index):
+            found = find_salt_lyt(index)
+            if not late_lyt.exists():  # after the crawl of the new directory, before it is watched
+                late_lyt.write_text(open(example_lyt).read().replace('example_tech', 'refresh_late'))
+            return found
+        monkeypatch.setattr(Technology, '_find_salt_lyt', find_then_write)
+        added, _, _ = Technology.refresh_salt()
+        assert sorted(os.path.basename(fn) for fn in added) == ['late.lyt', 'refresh_b.lyt']
+        assert Technology.has_technology('refresh_late')
+    finally:
+        Technology.reload_salt()
+
+
+@pytest.mark.parametrize('watch_salt', [True, False])
+def test_refresh_salt_recreated_grain(tmp_path, monkeypatch, watch_salt):
+    monkeypatch.setenv('KLAYOUT_HOME', str(tmp_path))
+    monkeypatch.setattr(Technology, 'watch_salt', watch_salt)
+    monkeypatch.setattr(Technology, 'use_index', False)  # saving it makes events of its own
+    salt = tmp_path / 'salt'
+    make_salt(salt, ['refresh_a'])
+    Technology.reload_salt()
+    try:
+        Technology.refresh_salt()
+        Technology.refresh_salt()
+        shutil.rmtree(str(salt / 'refresh_a'))  # like reinstalling the grain
+        make_salt(salt, ['refresh_a'])
+        lyt_a = str(salt / 'refresh_a' / 'tech' / 'refresh_a' / 'refresh_a.lyt')
+        assert Technology.refresh_salt() == ([], [lyt_a], [])
+        assert Technology.refresh_salt() == ([], [], [])
+
+        with open(lyt_a) as fx:
+            xml = fx.read()
+        with open(lyt_a, 'w') as fx:
+            fx.write(xml.replace('<name>refresh_a</name>', '<name>refresh_renamed</name>'))
+        assert Technology.refresh_salt() == ([], [lyt_a], [])
+        assert Technology.has_technology('refresh_renamed')
+        assert not Technology.has_technology('refresh_a')
+    finally:
+        Technology.reload_salt()
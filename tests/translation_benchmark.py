@@ -0,0 +1,190 @@
+''' Timing of the cell translation layer. Not collected by pytest. Run it directly:
+
+        python translation_benchmark.py                      # full sweep, results in translation_benchmark.json
+        python translation_benchmark.py --quick -o new.json  # smaller sizes
+        python translation_benchmark.py --compare old.json   # also flag cases that got slower than old.json
+
+    Each sweep varies one parameter around a base case:
+    polygon count, vertex count, hierarchy depth, and references per level.
+    Each case is run in both directions (phidl->pya, pya->phidl) through every method:
+        direct, buffer, file: anyCell_to_anyCell with the object-to-object converter, the in-memory buffer, or the temporary file
+        any_write, any_read: one half of the buffer path
+        phidl2pya_flat, phidl2pya_flat_batched: phidl->pya only
+
+    The results file is JSON: {"meta": {...versions...}, "results": [{...case..., "method": ..., "seconds": ...}, ...]}
+'''
+import io
+import sys
+import json
+import time
+import math
+import platform
+import argparse
+from lygadgets import pya, any_write, any_read, anyCell_to_anyCell
+from lygadgets.cell_translation import phidl2pya_flat
+import phidl
+from phidl import Device
+
+base_case = dict(npolygons=1000, nvertices=4, depth=1, nreferences=4)
+sweeps = dict(npolygons=[100, 1000, 10000, 100000],
+              nvertices=[4, 64, 512],
+              depth=[0, 1, 2, 3],
+              nreferences=[1, 4, 16, 64])
+quick_sweeps = dict(npolygons=[100, 1000],
+                    nvertices=[4, 64],
+                    depth=[0, 2],
+                    nreferences=[1, 16])
+directions = ['phidl->pya', 'pya->phidl']
+
+
+def hierarchical_device(npolygons, nvertices, depth, nreferences):
+    ''' A leaf cell of npolygons regular polygons, referenced nreferences times by each of depth levels of parents '''
+    angles = [2 * math.pi * i / nvertices for i in range(nvertices)]
+    outline = [(math.cos(a), math.sin(a)) for a in angles]
+    device = Device('leaf')
+    ncolumns = int(math.ceil(math.sqrt(npolygons)))
+    for i in range(npolygons):
+        x0, y0 = 3 * (i % ncolumns), 3 * (i // ncolumns)
+        device.add_polygon([(x0 + x, y0 + y) for x, y in outline], layer=1)
+    for level in range(depth):
+        parent = Device('level{}'.format(level + 1))
+        for i in range(nreferences):
+            (parent << device).movex(1.1 * i * device.xsize)
+        device = parent
+    return device
+
+
+def source_and_target(case, direction):
+    ''' Keep the returned layouts alive as long as their cells are used '''
+    device = hierarchical_device(**case)
+    if direction == 'phidl->pya':
+        target_layout = pya.Layout()
+        return device, (lambda: target_layout.create_cell('target')), target_layout
+    source_layout = pya.Layout()
+    source = source_layout.create_cell('source')
+    anyCell_to_anyCell(device, source)
+    return source, Device, source_layout
+
+
+def best_time(function, setup, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        args = setup()
+        tstart = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - tstart)
+    return best
+
+
+def time_methods(case, direction, repeats):
+    source, new_target, _keepalive = source_and_target(case, direction)
+
+    def written():
+        buffer = io.BytesIO()
+        any_write(source, buffer, write_ports=True)
+        buffer.seek(0)
+        return new_target(), buffer
+
+    methods = {
+        'direct': (lambda t: anyCell_to_anyCell(source, t, direct=True), lambda: (new_target(),)),
+        'buffer': (lambda t: anyCell_to_anyCell(source, t, direct=False), lambda: (new_target(),)),
+        'file': (lambda t: anyCell_to_anyCell(source, t, direct=False, in_memory=False), lambda: (new_target(),)),
+        'any_write': (lambda b: any_write(source, b, write_ports=True), lambda: (io.BytesIO(),)),
+        'any_read': (any_read, written),
+    }
+    if direction == 'phidl->pya':
+        methods['phidl2pya_flat'] = (lambda t: phidl2pya_flat(t, source), lambda: (new_target(),))
+        methods['phidl2pya_flat_batched'] = (lambda t: phidl2pya_flat(t, source, batched=True), lambda: (new_target(),))
+    for method, (function, setup) in methods.items():
+        yield method, best_time(function, setup, repeats)
+
+
+def intermediate_formats(nshapes=100000, repeats=3):
+    ''' GDS2 vs OASIS for pya->pya, with lots of repeated shapes '''
+    layout = pya.Layout()
+    layout.dbu = 0.001
+    cell = layout.create_cell('repeated')
+    shapes = cell.shapes(layout.layer(1, 0))
+    for i in range(nshapes):
+        shapes.insert(pya.Box(0, 0, 500, 1000).moved(i % 300 * 1000, i // 300 * 2000))
+    target_layout = pya.Layout()
+    for format in ['GDS2', 'OASIS']:
+        buffer = io.BytesIO()
+        seconds = best_time(lambda b: any_write(cell, b, format=format), lambda: (io.BytesIO(),), repeats)
+        yield 'write_' + format, seconds
+        any_write(cell, buffer, format=format)
+
+        def rewound():
+            buffer.seek(0)
+            return target_layout.create_cell('target'), buffer
+        yield 'read_' + format, best_time(any_read, rewound, repeats)
+        yield 'bytes_' + format, len(buffer.getvalue())
+
+
+def run(quick=False, repeats=3, progress=print):
+    results = []
+    for parameter, values in (quick_sweeps if quick else sweeps).items():
+        for value in values:
+            case = dict(base_case, **{parameter: value})
+            for direction in directions:
+                for method, seconds in time_methods(case, direction, repeats):
+                    row = dict(case, sweep=parameter, direction=direction, method=method, seconds=seconds)
+                    progress('{sweep:12s} {npolygons:7d} {nvertices:4d} {depth:2d} {nreferences:3d}'
+                             ' {direction:11s} {method:24s} {seconds:9.4f}'.format(**row))
+                    results.append(row)
+    for method, value in intermediate_formats(10000 if quick else 100000, repeats):
+        progress('{:12s} {:24s} {}'.format('format', method, value))
+        results.append(dict(sweep='format', direction='pya->pya', method=method,
+                            **{'bytes' if method.startswith('bytes') else 'seconds': value}))
+    return results
+
+
+def metadata():
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                klayout=getattr(pya, '__version__', None),
+                phidl=phidl.__version__)
+
+
+def result_key(row):
+    return tuple(row.get(k) for k in ['sweep', 'direction', 'method', 'npolygons', 'nvertices', 'depth', 'nreferences'])
+
+
+def compare(results, baseline, threshold=1.25):
+    ''' Returns the rows that are more than threshold times slower than the matching rows of baseline '''
+    before = {result_key(row): row['seconds'] for row in baseline if 'seconds' in row}
+    slower = []
+    for row in results:
+        old = before.get(result_key(row))
+        if old and 'seconds' in row and row['seconds'] > threshold * old:
+            slower.append(dict(row, baseline_seconds=old, ratio=row['seconds'] / old))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark lygadgets cell translation')
+    parser.add_argument('-o', '--output', default='translation_benchmark.json')
+    parser.add_argument('--quick', action='store_true', help='smaller sweeps')
+    parser.add_argument('--repeats', type=int, default=3, help='best of this many runs')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.repeats)
+    with open(args.output, 'w') as fx:
+        json.dump(dict(meta=metadata(), results=results), fx, indent=1)
+    print('Wrote', args.output)
+
+    if args.compare:
+        with open(args.compare) as fx:
+            baseline = json.load(fx)['results']
+        slower = compare(results, baseline, args.threshold)
+        for row in slower:
+            print('SLOWER x{ratio:.2f}: {sweep} {direction} {method}'.format(**row))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
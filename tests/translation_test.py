@@ -1,5 +1,10 @@
 import os, sys
-from lygadgets import anyCell_to_anyCell, pya, any_write
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pytest
+from lygadgets import anyCell_to_anyCell, pya, any_write, any_read, translate_many
+from lygadgets.cell_translation import phidl2pya_flat, TranslationCache, intermediate_format
+from lygadgets.cell_translation import Backend, register_backend, celltype_to_write_function
 from lytest import run_xor
 from phidl import Device, geometry as pg
 
@@ -8,16 +13,16 @@ sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),
                                               'tech', 'example_tech')))
 from lygadgets_pcells.pcell_examples import some_device
 
-def back_and_forth():
+def back_and_forth(**kwargs):
     # from phidl to pya and back
     init_device = some_device(10, 20)
 
     pya_layout = pya.Layout()
     pya_cell = pya_layout.create_cell('newname')
-    anyCell_to_anyCell(init_device, pya_cell)
+    anyCell_to_anyCell(init_device, pya_cell, **kwargs)
 
     final_device = Device()
-    anyCell_to_anyCell(pya_cell, final_device)
+    anyCell_to_anyCell(pya_cell, final_device, **kwargs)
 
     return init_device, pya_layout, final_device
 
@@ -26,16 +31,18 @@ def test_translation_running():
     back_and_forth()
 
 
+def geom_equal(A, B):
+    h1 = A.hash_geometry(precision = 1e-4)
+    h2 = B.hash_geometry(precision = 1e-4)
+    return h1 == h2
+
+
 def phidl_port_translation():
     # Conversion between object and geometric representation of ports
     try:
         pg.with_geometric_ports
     except AttributeError:
         pass  # skipping
-    def geom_equal(A, B):
-        h1 = A.hash_geometry(precision = 1e-4)
-        h2 = B.hash_geometry(precision = 1e-4)
-        return h1 == h2
     init_D = pg.compass(layer = 1)
     geom_D = pg.with_geometric_ports(init_D, layer = 2)
     end_D = pg.with_object_ports(geom_D, layer = 2)
@@ -57,10 +64,9 @@ def phidl_port_translation():
     assert init_D.name == end2.name
 
 
-def test_translation_correct():
-    # do an XOR test
+def xor_back_and_forth(**kwargs):
     filenames = ['test{}.gds'.format(ifile) for ifile in range(3)]
-    cell_list = back_and_forth()
+    cell_list = back_and_forth(**kwargs)
     for fn, cell in zip(filenames, cell_list):
         any_write(cell, fn)
 
@@ -70,3 +76,391 @@ def test_translation_correct():
     finally:
         [os.remove(fn) for fn in filenames]
         pass
+
+
+def test_translation_correct():
+    # do an XOR test
+    xor_back_and_forth()
+
+
+def test_translation_through_buffer():
+    xor_back_and_forth(direct=False)
+
+
+def test_translation_through_file():
+    # the fallback when streams are not supported
+    xor_back_and_forth(direct=False, in_memory=False)
+
+
+def test_intermediate_format():
+    assert intermediate_format(pya.Cell, pya.Layout) == 'OASIS'
+    assert intermediate_format(pya.Cell, Device) == 'GDS2'
+    assert intermediate_format(Device, pya.Cell) == 'GDS2'
+
+    pya_layout = pya.Layout()
+    pya_layout.dbu = 0.001
+    src = pya_layout.create_cell('src')
+    src.shapes(pya_layout.layer(1, 0)).insert(pya.DBox(0, 0, 3, 4))
+    other_layout = pya.Layout()
+    for in_memory in [True, False]:
+        dest = other_layout.create_cell('dest')
+        anyCell_to_anyCell(src, dest, in_memory=in_memory)
+        assert dest.dbbox() == src.dbbox()
+
+
+class RawCell(object):
+    # a layout language that only knows how to hold GDS bytes
+    def __init__(self):
+        self.data = b''
+
+
+class RawBackend(Backend):
+    name = 'raw'
+    module = __name__
+
+    def celltypes(self):
+        return (RawCell,)
+
+    def write_function(self, celltype):
+        def write_raw(cell, filename, *args, **kwargs):
+            filename.write(cell.data)
+        return write_raw
+
+    def read_function(self, celltype):
+        def read_raw(cell, filename, *args, **kwargs):
+            cell.data = filename.read()
+            return cell
+        return read_raw
+
+    def supports_streams(self, celltype):
+        return True
+
+
+def test_backend_registry():
+    assert celltype_to_write_function(pya.Cell) is celltype_to_write_function(pya.Cell)  # cached
+    register_backend(RawBackend())
+    pya_layout = pya.Layout()
+    src = pya_layout.create_cell('src')
+    src.shapes(pya_layout.layer(1, 0)).insert(pya.Box(0, 0, 3, 4))
+    raw = anyCell_to_anyCell(src, RawCell())
+    assert raw.data.startswith(b'\x00\x06\x00\x02')  # GDS2 HEADER record
+    dest = anyCell_to_anyCell(raw, pya_layout.create_cell('dest'))
+    assert dest.bbox() == src.bbox()
+
+
+def test_gdstk_backend():
+    gdstk = pytest.importorskip('gdstk')
+    assert intermediate_format(pya.Cell, gdstk.Cell) == 'OASIS'
+    src = pya.Layout()
+    leaf = src.create_cell('leaf')
+    leaf.shapes(src.layer(1, 0)).insert(pya.Box(0, 0, 100, 100))
+    top = src.create_cell('top')
+    top.insert(pya.CellInstArray(leaf.cell_index(), pya.Trans(), pya.Vector(200, 0), pya.Vector(0, 200), 3, 2))
+    top.shapes(src.layer(2, 0)).insert(pya.Box(0, 0, 1000, 1000))
+
+    gdstk_cell = anyCell_to_anyCell(top, gdstk.Cell('gdstk_top'))
+    assert gdstk_cell.name == 'top'
+    assert np.allclose(gdstk_cell.bounding_box(), [[0, 0], [1, 1]])
+    assert len(gdstk_cell.references) == 1
+    pya_layout = pya.Layout()
+    dest = anyCell_to_anyCell(gdstk_cell, pya_layout.create_cell('dest'))
+    assert dest.dbbox() == top.dbbox()
+    assert dest.child_cells() == 1
+    for layer_info in [pya.LayerInfo(1, 0), pya.LayerInfo(2, 0)]:
+        src_region = pya.Region(top.begin_shapes_rec(src.layer(layer_info)))
+        dest_region = pya.Region(dest.begin_shapes_rec(pya_layout.layer(layer_info)))
+        assert (src_region ^ dest_region).is_empty()
+
+    device = some_device(10, 20)
+    gdstk_device = anyCell_to_anyCell(device, gdstk.Cell('from_phidl'))
+    assert np.allclose(gdstk_device.bounding_box(), device.bbox)
+
+    fn = 'test_gdstk.oas'
+    any_write(top, fn)
+    try:
+        with pytest.raises(ValueError, match='no cell named nothing'):
+            any_read(gdstk.Cell('target'), fn, cellname='nothing')
+    finally:
+        os.remove(fn)
+
+
+def test_hierarchy_preserved():
+    # repeated subdevices share one cell
+    unit = pg.rectangle((1, 2), layer=1)
+    D = Device('parent')
+    for i in range(5):
+        (D << unit).movex(3 * i)
+    D.add_array(unit, columns=4, rows=3, spacing=(3, 4)).movey(10)
+
+    pya_layout = pya.Layout()
+    pya_cell = pya_layout.create_cell('newname')
+    anyCell_to_anyCell(D, pya_cell)
+    assert pya_layout.cells() == 2
+    assert pya_cell.child_instances() == 6
+
+    # and back
+    final_device = anyCell_to_anyCell(pya_cell, Device())
+    assert len(final_device.get_dependencies(recursive=True)) == 1
+    assert len(final_device.references) == 6
+    assert final_device.area() == D.area()
+    assert np.all(final_device.bbox == D.bbox)
+
+
+def test_transformed_arrays():
+    # klayout may store arrays read from a file with a and b swapped
+    src = pya.Layout()
+    leaf = src.create_cell('leaf')
+    leaf.shapes(src.layer(1, 0)).insert(pya.Polygon([pya.Point(0, 0), pya.Point(3000, 0), pya.Point(3000, 1000),
+                                                     pya.Point(1000, 1000), pya.Point(1000, 2000), pya.Point(0, 2000)]))
+    top = src.create_cell('top')
+    for rot in range(8):  # R0 to R270, then M0 to M135
+        disp = pya.Vector(100000 * rot, 0)
+        top.insert(pya.CellInstArray(leaf.cell_index(), pya.Trans(rot, disp), pya.Vector(0, 9000), pya.Vector(7000, 0), 2, 3))
+        top.insert(pya.CellInstArray(leaf.cell_index(), pya.Trans(rot, disp + pya.Vector(0, 50000)),
+                                     pya.Vector(7000, 0), pya.Vector(0, 9000), 2, 3))
+    for fn in ['test_arrays.gds', 'test_arrays.oas']:
+        src.write(fn)
+        try:
+            read_layout = pya.Layout()
+            read_cell = any_read(read_layout.create_cell('top'), fn)
+        finally:
+            os.remove(fn)
+        direct = anyCell_to_anyCell(read_cell, Device(), direct=True)
+        through_file = anyCell_to_anyCell(read_cell, Device(), direct=False)
+        assert np.allclose(direct.bbox, through_file.bbox)
+        assert geom_equal(direct, through_file)
+
+    D = Device('parent')
+    D.add_array(pg.L(width=1, size=(3, 2), layer=1), columns=2, rows=3, spacing=(7, 9)).rotate(90).mirror()
+    fn = 'test_mirrored.gds'
+    any_write(D, fn)
+    try:
+        read_layout = pya.Layout()
+        read_cell = any_read(read_layout.create_cell('top'), fn)
+    finally:
+        os.remove(fn)
+    direct = anyCell_to_anyCell(read_cell, Device(), direct=True)
+    assert geom_equal(direct, anyCell_to_anyCell(read_cell, Device(), direct=False))
+    assert np.allclose(direct.bbox, D.bbox)
+
+
+def test_flat_batched():
+    # bulk insertion gives the same geometry as one-by-one
+    D = some_device(10, 20)
+    D.add_array(pg.rectangle((1, 2), layer=2), columns=4, rows=3, spacing=(3, 4)).rotate(15)
+    pya_layout = pya.Layout()
+    one_by_one = pya_layout.create_cell('one_by_one')
+    batched = pya_layout.create_cell('batched')
+    phidl2pya_flat(batched, D, batched=True)
+    phidl2pya_flat(one_by_one, D)
+    for layer in pya_layout.layer_indexes():
+        region1 = pya.Region(one_by_one.shapes(layer))
+        region2 = pya.Region(batched.shapes(layer))
+        assert region1.count() == region2.count()
+        assert (region1 ^ region2).is_empty()
+
+
+def test_flat_batched_duplicate_names():
+    # klayout allows several cells with the same name. The shapes go where they are asked to
+    rect = pg.rectangle((3, 4), layer=1)
+    pya_layout = pya.Layout()
+    first = pya_layout.create_cell('a')
+    second = pya_layout.create_cell('b')
+    second.name = 'a'
+    phidl2pya_flat(second, rect, batched=True)
+    assert first.is_empty()
+    assert second.dbbox() == pya.DBox(0, 0, 3, 4)
+    unicode_cell = pya_layout.create_cell('\u00b5cell')
+    phidl2pya_flat(unicode_cell, rect, batched=True)
+    assert unicode_cell.dbbox() == pya.DBox(0, 0, 3, 4)
+    assert pya_layout.cells() == 3
+
+
+def test_streaming_write():
+    D = Device('parent')
+    for i in range(3):
+        (D << some_device(10, 20)).movex(40 * i)
+    D.add_port(name='out', midpoint=(0, 0), width=2, orientation=90)
+    filenames = ['test_whole.gds', 'test_streamed.gds']
+    calls = []
+    any_write(D, filenames[0])
+    any_write(D, filenames[1], streaming=True, progress=lambda *args: calls.append(args))
+    try:
+        run_xor(*filenames)
+        assert any_read(Device(), filenames[1]).ports['out'].width == 2
+    finally:
+        [os.remove(fn) for fn in filenames]
+    assert len(calls) == len(D.get_dependencies(recursive=True)) + 1
+    assert calls[-1] == (len(calls), len(calls), 'toplevel')
+    assert D.name == 'parent'
+
+
+def test_read_named_cell():
+    src = pya.Layout()
+    leaf = src.create_cell('leaf')
+    leaf.shapes(src.layer(1, 0)).insert(pya.Box(0, 0, 100, 100))
+    block = src.create_cell('block')
+    block.insert(pya.CellInstArray(leaf.cell_index(), pya.Trans(), pya.Vector(200, 0), pya.Vector(0, 200), 3, 2))
+    chip = src.create_cell('chip')
+    chip.insert(pya.CellInstArray(block.cell_index(), pya.Trans(1000, 0)))
+    chip.shapes(src.layer(2, 0)).insert(pya.Box(0, 0, 1000, 1000))
+    src.create_cell('second_top')
+
+    for fn in ['test_chip.gds', 'test_chip.oas']:
+        src.write(fn)
+        try:
+            pya_layout = pya.Layout()
+            already_there = pya_layout.create_cell('leaf')
+            target = any_read(pya_layout.create_cell('target'), fn, cellname='block')
+        finally:
+            os.remove(fn)
+        assert target.name == 'block'
+        assert target.bbox() == block.bbox()
+        assert already_there.is_empty()
+        assert sorted(c.name for c in pya_layout.each_cell()) == ['block', 'leaf', 'leaf$1']
+
+
+def test_incremental_translation():
+    big = some_device(10, 20)
+
+    def design(width):
+        D = Device('top')
+        D << big
+        (D << pg.rectangle((width, 1), layer=3)).movey(-10)
+        return D
+
+    pya_layout = pya.Layout()
+    pya_cell = pya_layout.create_cell('newname')
+    anyCell_to_anyCell(design(1), pya_cell, incremental=True)
+    big_cell = pya_layout.cell('somedevice')
+    big_cell_shapes = big_cell.shapes(pya_layout.layer(1, 0)).size()
+    cell_count = len(list(pya_layout.each_cell()))
+
+    anyCell_to_anyCell(design(5), pya_cell, incremental=True)
+    assert pya_layout.cell('somedevice').cell_index() == big_cell.cell_index()  # not rebuilt
+    assert big_cell.shapes(pya_layout.layer(1, 0)).size() == big_cell_shapes
+    assert pya.Region(pya_cell.begin_shapes_rec(pya_layout.layer(3, 0))).area() == 5 / pya_layout.dbu ** 2
+    assert len(list(pya_layout.each_cell())) == cell_count  # the old rectangle is gone
+
+    full_layout = pya.Layout()
+    full_cell = anyCell_to_anyCell(design(5), full_layout.create_cell('newname'))
+    assert full_cell.dbbox() == pya_cell.dbbox()
+    assert pya_layout.top_cells()[0].name == 'toplevel'
+    assert len(pya_layout.top_cells()) == 1
+
+    # rebuilt subcells keep their names
+    def leaf(width):
+        L = pg.rectangle((width, 1), layer=1)
+        L.name = 'leaf'
+        return L
+
+    def two_leaves(width_a, width_b):
+        D = Device('top')
+        D << leaf(width_a)
+        (D << leaf(width_b)).movey(10)
+        return D
+
+    pya_layout = pya.Layout()
+    pya_cell = pya_layout.create_cell('newname')
+    for widths in [(1, 1), (2, 1), (2, 3), (1, 1), (4, 4)]:
+        anyCell_to_anyCell(two_leaves(*widths), pya_cell, incremental=True)
+        # identical subcells share a cell. Otherwise the second one is suffixed, as in a full translation
+        expected = ['leaf', 'toplevel'] if widths[0] == widths[1] else ['leaf', 'leaf$1', 'toplevel']
+        assert sorted(c.name for c in pya_layout.each_cell()) == expected
+        full_layout = pya.Layout()
+        full_cell = anyCell_to_anyCell(two_leaves(*widths), full_layout.create_cell('newname'))
+        assert full_cell.dbbox() == pya_cell.dbbox()
+
+
+def test_translation_cache():
+    cache = TranslationCache(maxsize=2)
+    pya_layout = pya.Layout()
+    cells = [pya_layout.create_cell('c{}'.format(i)) for i in range(3)]
+    anyCell_to_anyCell(some_device(10, 20), cells[0], cache=cache)
+    anyCell_to_anyCell(some_device(10, 20), cells[1], cache=cache)  # same geometry
+    assert cache.info().hits == 1
+    assert cache.info().misses == 1
+    region0 = pya.Region(cells[0].begin_shapes_rec(pya_layout.layer(1, 0)))
+    region1 = pya.Region(cells[1].begin_shapes_rec(pya_layout.layer(1, 0)))
+    assert (region0 ^ region1).is_empty()
+
+    # phidl targets get their own top-level copies
+    device0 = anyCell_to_anyCell(cells[0], Device(), cache=cache)
+    device1 = anyCell_to_anyCell(cells[1], Device(), cache=cache)
+    assert cache.info().hits == 2
+    device1.movex(100)
+    assert device0.xmin == 0
+
+    # eviction
+    anyCell_to_anyCell(some_device(1, 2), cells[2], cache=cache)
+    assert cache.info().currsize == 2
+
+
+def test_translation_cache_dbu():
+    cache = TranslationCache()
+    coarse = pya.Layout()
+    coarse.dbu = 0.01
+    anyCell_to_anyCell(pg.rectangle((5, 5)), coarse.create_cell('coarse'), cache=cache)
+    boxes = []
+    for _ in range(2):  # a miss, then a hit
+        fine = pya.Layout()
+        fine.dbu = 0.001
+        cell = anyCell_to_anyCell(pg.rectangle((1.234, 1.001)), fine.create_cell('fine'), cache=cache)
+        boxes.append(cell.dbbox())
+    assert cache.info().hits == 1
+    assert boxes[0] == boxes[1] == pya.DBox(0, 0, 1.234, 1.001)
+
+    coarse2 = pya.Layout()
+    coarse2.dbu = 0.01
+    cell = anyCell_to_anyCell(pg.rectangle((1.234, 1.001)), coarse2.create_cell('coarse'), cache=cache)
+    assert cache.info().misses == 3  # a different grid is a different result
+    assert cell.dbbox() == pya.DBox(0, 0, 1.23, 1)
+
+
+def test_translate_many():
+    devices = [some_device(10 + i, 20) for i in range(4)]
+    pya_layout = pya.Layout()
+    for processes in [None, 2]:
+        pya_cells = translate_many(devices, lambda: pya_layout.create_cell('x'), processes=processes)
+        assert [c.name for c in pya_cells] == ['somedevice', 'somedevice$1', 'somedevice$2', 'somedevice$3']
+        for device, pya_cell in zip(devices, pya_cells):
+            assert np.allclose(pya_cell.dbbox().width(), device.xsize)
+    final_devices = translate_many(pya_cells, Device)
+    for device, final_device in zip(devices, final_devices):
+        assert np.allclose(final_device.bbox, device.bbox)
+
+    # common subcells are translated once, and shared
+    shared = some_device(10, 20)
+    tops = []
+    for i in range(5):
+        top = Device('top')
+        (top << shared).movex(100 * i)
+        tops.append(top)
+    shared_layout = pya.Layout()
+    pya_cells = translate_many(tops, lambda: shared_layout.create_cell('x'))
+    assert shared_layout.cells() == 5 + len(shared.get_dependencies(recursive=True)) + 1
+    assert [c.name for c in pya_cells] == ['top', 'top$1', 'top$2', 'top$3', 'top$4']
+    final_devices = translate_many(pya_cells, Device)
+    assert final_devices[0].references[0].parent is final_devices[1].references[0].parent
+    copy_layout = pya.Layout()
+    pya_copies = translate_many(pya_cells, lambda: copy_layout.create_cell('copy'))
+    assert copy_layout.cells() == shared_layout.cells()
+    assert pya_copies[3].dbbox() == pya_cells[3].dbbox()
+
+
+def _translated_bbox(width, in_memory=False):
+    # runs in threads and worker processes
+    pya_layout = pya.Layout()
+    pya_cell = pya_layout.create_cell('newname')
+    anyCell_to_anyCell(some_device(width, 20), pya_cell, direct=False, in_memory=in_memory)
+    final_device = anyCell_to_anyCell(pya_cell, Device(), direct=False, in_memory=in_memory)
+    return tuple(final_device.bbox.flatten())
+
+
+def test_concurrent_translation():
+    widths = [10 + i for i in range(8)]
+    expected = [_translated_bbox(w, in_memory=True) for w in widths]
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(_translated_bbox, widths)) == expected
+    with ProcessPoolExecutor(2) as pool:
+        assert list(pool.map(_translated_bbox, widths)) == expected